@@ -0,0 +1,129 @@
+"""
+aoi_grid.py
+Lazy loading of the AOI grid, page by page from an EE FeatureCollection, or from a local GeoJSON or GeoPackage file.
+"""
+import json
+import os
+import sqlite3
+import struct
+from typing import Iterator
+import ee
+
+
+def iter_features(source: ee.FeatureCollection | str, page_size: int = 1000) -> Iterator[dict]:
+    """Stream the features of an AOI grid as GeoJSON dicts, in the order of the grid.
+
+    Only one page of an EE collection is held at a time, so the first tile is available after one request and memory
+    does not grow with the grid. Local files are read without any request: GeoJSON (.geojson, .json), line delimited
+    GeoJSON (.geojsonl, .geojsons, one feature per line) and GeoPackage (.gpkg, its first feature table), all in
+    EPSG:4326. A .geojson file is parsed as a whole, use line delimited GeoJSON for very large grids.
+
+    Args:
+        source (ee.FeatureCollection | str): EE collection, or path to a local file.
+        page_size (int): Number of features fetched per request from an EE collection. Defaults to 1000.
+
+    Yields:
+        dict: GeoJSON feature.
+    """
+    if not isinstance(source, str):
+        yield from _iter_ee_features(source, page_size)
+        return
+    match os.path.splitext(source)[1].lower():
+        case '.geojson' | '.json':
+            with open(source) as f:
+                yield from json.load(f)['features']
+        case '.geojsonl' | '.geojsons':
+            with open(source) as f:
+                for line in f:
+                    # GeoJSON text sequences start each record with a record separator
+                    line = line.strip().lstrip('\x1e')
+                    if line:
+                        yield json.loads(line)
+        case '.gpkg':
+            yield from _iter_geopackage(source)
+        case extension:
+            raise ValueError(f'The AOI grid file type [{extension}] is not supported.')
+
+
+def _iter_ee_features(collection: ee.FeatureCollection, page_size: int) -> Iterator[dict]:
+    offset = 0
+    while True:
+        page = collection.toList(page_size, offset).getInfo()
+        yield from page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def _iter_geopackage(path: str) -> Iterator[dict]:
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        row = conn.execute(
+            '''SELECT c.table_name, g.column_name, g.srs_id FROM gpkg_contents c
+               JOIN gpkg_geometry_columns g ON g.table_name = c.table_name
+               WHERE c.data_type = 'features' ORDER BY c.table_name LIMIT 1''').fetchone()
+        if row is None:
+            raise ValueError(f'No feature table in {path}')
+        table, column, srs_id = row
+        if srs_id != 4326:
+            raise ValueError(f'The AOI grid in {path} must be in EPSG:4326, not in srs {srs_id}')
+        for (blob,) in conn.execute(f'SELECT "{column}" FROM "{table}" ORDER BY rowid'):
+            yield {'type': 'Feature', 'geometry': gpkg_geometry(blob), 'properties': {}}
+    finally:
+        conn.close()
+
+
+def gpkg_geometry(blob: bytes) -> dict:
+    """Decode a GeoPackage geometry blob holding a 2D (Multi)Polygon into GeoJSON.
+
+    Examples:
+        >>> wkb = struct.pack('<BIII', 1, 3, 1, 4) + struct.pack('<8d', 0, 0, 1, 0, 1, 1, 0, 0)
+        >>> gpkg_geometry(b'GP' + bytes([0, 1]) + struct.pack('<i', 4326) + wkb)
+        {'type': 'Polygon', 'coordinates': [[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]]}
+    """
+    if blob[:2] != b'GP':
+        raise ValueError('Not a GeoPackage geometry')
+    # Flags: bit 0 is the byte order of the header, bits 1-3 the kind of envelope before the WKB
+    envelope_size = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}[(blob[3] >> 1) & 0b111]
+    geometry, _ = _read_wkb(blob, 8 + envelope_size)
+    return geometry
+
+
+def _read_wkb(buffer: bytes, offset: int) -> tuple[dict, int]:
+    order = '<' if buffer[offset] == 1 else '>'
+    (geometry_type,) = struct.unpack_from(f'{order}I', buffer, offset + 1)
+    offset += 5
+
+    def read_count() -> int:
+        nonlocal offset
+        (count,) = struct.unpack_from(f'{order}I', buffer, offset)
+        offset += 4
+        return count
+
+    def read_polygon() -> list:
+        nonlocal offset
+        rings = []
+        for _ in range(read_count()):
+            num_points = read_count()
+            values = struct.unpack_from(f'{order}{2 * num_points}d', buffer, offset)
+            offset += 16 * num_points
+            rings.append([[values[i], values[i + 1]] for i in range(0, len(values), 2)])
+        return rings
+
+    match geometry_type:
+        case 3:
+            return {'type': 'Polygon', 'coordinates': read_polygon()}, offset
+        case 6:
+            polygons = []
+            for _ in range(read_count()):
+                polygon, offset = _read_wkb(buffer, offset)
+                polygons.append(polygon['coordinates'])
+            return {'type': 'MultiPolygon', 'coordinates': polygons}, offset
+        case _:
+            raise ValueError(f'The WKB geometry type [{geometry_type}] is not supported.')
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
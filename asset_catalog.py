@@ -0,0 +1,116 @@
+"""
+asset_catalog.py
+On-disk cache of EE asset listings, keyed by parent folder or image collection.
+"""
+import json
+import os
+import threading
+import time
+import utils
+
+
+class AssetCatalog:
+    """Names of the assets directly under each listed parent, persisted as JSON between runs.
+
+    A parent is listed in full the first time it is asked for, or once its listing is older than `ttl` seconds. Assets
+    we create or delete ourselves are added to or removed from the cached listing instead of listing the parent again.
+    Those updates are written to disk at most every `save_interval` seconds, and by `flush()`.
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, save_interval: float = 30, clock=None):
+        """
+        Args:
+            path (str): JSON file the catalog is persisted to.
+            ttl (float): Seconds a listing stays valid.
+            save_interval (float): Seconds between two writes of incremental updates.
+            clock: Provides `time()`, defaults to the `time` module.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self.clock = clock or time
+        self._lock = threading.Lock()
+        self._listings: dict[str, dict] = {}
+        self._dirty = False
+        self._saved_at = 0.0
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._listings = {parent: {'listed_at': listing['listed_at'], 'names': set(listing['names'])}
+                                      for parent, listing in json.load(f).items()}
+            except (OSError, ValueError, KeyError) as e:
+                utils.log_err(f'Ignoring unreadable asset catalog {path}: {e}')
+
+    @staticmethod
+    def _split(asset_id: str) -> tuple[str, str]:
+        parent, _, name = asset_id.rstrip('/').rpartition('/')
+        return parent, name
+
+    def _save(self, force: bool = True):
+        self._dirty = True
+        if not force and self.clock.time() - self._saved_at < self.save_interval:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({parent: {'listed_at': listing['listed_at'], 'names': sorted(listing['names'])}
+                       for parent, listing in self._listings.items()}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._saved_at = self.clock.time()
+
+    def names(self, parent: str, refresh: bool = False) -> set[str]:
+        """Get the base names of the assets under parent.
+
+        Args:
+            parent (str): EE folder or image collection.
+            refresh (bool): List the parent even if the cached listing is still valid.
+
+        Returns:
+            set[str]: Asset base names, a copy which callers may modify.
+        """
+        parent = parent.rstrip('/')
+        with self._lock:
+            listing = self._listings.get(parent)
+            if listing and not refresh and self.clock.time() - listing['listed_at'] < self.ttl:
+                return set(listing['names'])
+        names = {name.split('/')[-1] for name in utils.iter_asset_names(parent)}
+        with self._lock:
+            self._listings[parent] = {'listed_at': self.clock.time(), 'names': names}
+            self._save()
+        return set(names)
+
+    def add(self, asset_id: str):
+        """Record an asset we created. Nothing happens if its parent has not been listed yet."""
+        parent, name = self._split(asset_id)
+        with self._lock:
+            if parent in self._listings and name not in self._listings[parent]['names']:
+                self._listings[parent]['names'].add(name)
+                self._save(force=False)
+
+    def remove(self, asset_id: str):
+        """Record an asset we deleted, together with the listing of its own children."""
+        asset_id = asset_id.rstrip('/')
+        parent, name = self._split(asset_id)
+        with self._lock:
+            if parent in self._listings:
+                self._listings[parent]['names'].discard(name)
+            self._listings.pop(asset_id, None)
+            self._save(force=False)
+
+    def invalidate(self, parent: str = None):
+        """Drop the cached listing of parent, or of every parent if it's None."""
+        with self._lock:
+            if parent is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(parent.rstrip('/'), None)
+            self._save()
+
+    def flush(self):
+        """Write pending incremental updates to disk."""
+        with self._lock:
+            if self._dirty:
+                self._save()
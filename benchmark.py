@@ -0,0 +1,296 @@
+"""
+benchmark.py
+Scheduler throughput benchmarks on the local fake Earth Engine backend (fake_ee.py).
+
+Every scenario runs in a fresh interpreter, either the export pipeline of main.py (ccdc_main plus ee_task_monitor), a
+full run of it followed by an incremental one, or the yearly exports of ccdc_result_handler.py, and reports tiles/hour,
+RPC counts and tasks in flight on the simulated clock.
+
+Usage:
+    python benchmark.py                  # run all scenarios
+    python benchmark.py steady failures  # run the named scenarios
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+SCENARIOS = {
+    'steady': {
+        'tiles': 100,
+        'queue_latency': 120,
+        'task_duration': 900,
+    },
+    'failures': {
+        'tiles': 100,
+        'queue_latency': 120,
+        'task_duration': 900,
+        'failures': {'User memory limit exceeded.': 0.1, 'Execution failed; out of memory.': 0.05},
+    },
+    'slow_rpc': {
+        'tiles': 100,
+        'queue_latency': 120,
+        'task_duration': 900,
+        'rpc_latency': 0.5,
+    },
+    'congested': {
+        'tiles': 200,
+        'queue_latency': 60,
+        'task_duration': 900,
+        'slots': 20,
+    },
+    'local_sink': {
+        'tiles': 20,
+        'queue_latency': 120,
+        'task_duration': 900,
+        'tile_size': 0.01,
+        'rpc_latency': 2.0,
+        'pixel_failures': 0.05,
+        'sink': 'local',
+        'speedup': 20,  # Chunks are written to disk in real time
+    },
+    'incremental': {
+        'pipeline': 'incremental',
+        'tiles': 100,
+        'queue_latency': 120,
+        'task_duration': 900,
+        'changed': 0.1,
+    },
+    'handler': {
+        'pipeline': 'handler',
+        'tiles': 50,
+        'queue_latency': 120,
+        'task_duration': 600,
+    },
+    'handler_multi_year': {
+        'pipeline': 'handler',
+        'tiles': 50,
+        'queue_latency': 120,
+        'task_duration': 900,
+        'multi_year': True,
+    },
+    'handler_array': {
+        'pipeline': 'handler',
+        'tiles': 50,
+        'queue_latency': 120,
+        'task_duration': 600,
+        'array_extraction': True,
+    },
+}
+SPEEDUP = 1000
+
+
+def _uniform(mean: float, backend):
+    return lambda task: backend.random.uniform(0.5 * mean, 1.5 * mean)
+
+
+def _serve_tile_costs(backend, features: list[dict]) -> list[list]:
+    """Answer the table of main.tile_costs, the only one fetched with reduceColumns, with one row per grid feature.
+
+    Returns:
+        list[list]: The rows, (scene count, cloud free fraction, area, latest scene), which may be changed later.
+    """
+    from geometry import BBox
+
+    rows = [[backend.scene_count, 0.8, BBox.from_geojson(feature['geometry']).area(), 1750000000000]
+            for feature in features]
+    backend.info_handlers['get'] = lambda obj: rows if obj.source.func == 'reduceColumns' else None
+    return rows
+
+
+def run_main_scenario(tiles: int, queue_latency: float, task_duration: float, failures: dict = None,
+                      rpc_latency: float = 0.0, speedup: float = SPEEDUP, tile_size: float = 0.1,
+                      pixel_failures: float = 0.0, sink: str = 'asset', slots: int = None) -> dict:
+    """Run the main.py export pipeline over `tiles` grid cells on the fake backend.
+
+    Must run in a fresh interpreter, main.py keeps its queues in module globals. With `sink='local'` the tiles are
+    downloaded with computePixels and the makespan is the time ccdc_main takes.
+
+    Returns:
+        dict: Benchmark results.
+    """
+    import fake_ee
+
+    os.chdir(tempfile.mkdtemp(prefix='ccdc_bench_'))
+    backend = fake_ee.install(fake_ee.Backend(speedup=speedup, failures=failures, rpc_latency=rpc_latency,
+                                              pixel_failures=pixel_failures, slots=slots))
+    backend.queue_latency = _uniform(queue_latency, backend)
+    backend.task_duration = _uniform(task_duration, backend)
+    num_cols = int(tiles ** 0.5) or 1
+    features = fake_ee.grid_features(num_cols, -(-tiles // num_cols), tile_size)[:tiles]
+    backend.feature_collections['projects/project-id/assets/AOIs/aoi'] = features
+    _serve_tile_costs(backend, features)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        main.time = backend.clock
+        main.pixel_sink.time = backend.clock
+        main.EXPORT_SINK = sink
+        main.CONCURRENCY.clock = backend.clock
+        monitor = threading.Thread(target=main.ee_task_monitor)
+        if sink == 'asset':
+            monitor.start()
+        submission_start = backend.clock.time()
+        main.ccdc_main()
+        main.SUBMISSION_DONE.set()
+        submission_seconds = backend.clock.time() - submission_start
+        if sink == 'asset':
+            monitor.join()
+        main.utils.LOG_WRITER.close()
+
+    stats = backend.stats()
+    if sink == 'asset':
+        completed = stats['states'].get('COMPLETED', 0)
+        makespan = stats['makespan_seconds']
+    else:
+        completed = len(main.LEDGER.rows(main.ledger.COMPLETED))
+        makespan = submission_seconds
+    return {
+        'tiles': tiles,
+        'exports_completed': completed,
+        'task_states': stats['states'],
+        'submission_seconds': round(submission_seconds, 1),
+        'makespan_hours': round(makespan / 3600, 3),
+        'tiles_per_hour': round(completed / (makespan / 3600), 2) if makespan else 0.0,
+        'rpc_total': sum(stats['rpc_counts'].values()),
+        'rpc_counts': stats['rpc_counts'],
+        'mean_in_flight': round(stats['busy_seconds'] / makespan, 2) if makespan else 0.0,
+        'concurrency': main.CONCURRENCY.snapshot(),
+    }
+
+
+def run_incremental_scenario(tiles: int, queue_latency: float, task_duration: float, changed: float,
+                             speedup: float = SPEEDUP) -> dict:
+    """Run the main.py export pipeline over `tiles` grid cells, then again in incremental mode after new scenes were
+    added to a `changed` fraction of them.
+
+    Returns:
+        dict: Benchmark results of the incremental run.
+    """
+    import fake_ee
+
+    os.chdir(tempfile.mkdtemp(prefix='ccdc_bench_'))
+    backend = fake_ee.install(fake_ee.Backend(speedup=speedup))
+    backend.queue_latency = _uniform(queue_latency, backend)
+    backend.task_duration = _uniform(task_duration, backend)
+    num_cols = int(tiles ** 0.5) or 1
+    features = fake_ee.grid_features(num_cols, -(-tiles // num_cols), 0.1)[:tiles]
+    backend.feature_collections['projects/project-id/assets/AOIs/aoi'] = features
+    rows = _serve_tile_costs(backend, features)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        main.time = backend.clock
+        main.CONCURRENCY.clock = backend.clock
+        for incremental in (False, True):
+            if incremental:
+                for row in backend.random.sample(rows, round(changed * tiles)):
+                    row[0], row[3] = row[0] + 3, row[3] + 30 * 86400000
+            tasks_before = len(backend.tasks)
+            rpc_before = sum(backend.rpc_counts.values())
+            main.SUBMISSION_DONE.clear()
+            monitor = threading.Thread(target=main.ee_task_monitor)
+            monitor.start()
+            main.LEDGER.reset()
+            if incremental:
+                main.ccdc_main(skip=main.ee_task_incremental())
+            else:
+                main.LEDGER.record_inputs(main.tile_inputs())
+                main.ccdc_main()
+            main.SUBMISSION_DONE.set()
+            monitor.join()
+        main.utils.LOG_WRITER.close()
+
+    tasks = list(backend.tasks.values())[tasks_before:]
+    makespan = (max(task['end'] for task in tasks) - min(task['start'] for task in tasks)) if tasks else 0.0
+    return {
+        'tiles': tiles,
+        'tiles_changed': round(changed * tiles),
+        'exports_started': len(tasks),
+        'makespan_hours': round(makespan / 3600, 3),
+        'rpc_total': sum(backend.rpc_counts.values()) - rpc_before,
+        'assets': sum(name.startswith('/CCDC/ccdc_raw/') for name in backend.assets),
+    }
+
+
+def run_handler_scenario(tiles: int, queue_latency: float, task_duration: float, failures: dict = None,
+                         rpc_latency: float = 0.0, speedup: float = SPEEDUP, slots: int = None, years: int = 3,
+                         max_exports: int = 32, multi_year: bool = False, array_extraction: bool = False) -> dict:
+    """Run ccdc_result_handler over `tiles` raw CCDC assets for `years` years on the fake backend.
+
+    Returns:
+        dict: Benchmark results, `tiles_per_hour` counts exports.
+    """
+    import fake_ee
+
+    os.chdir(tempfile.mkdtemp(prefix='ccdc_bench_'))
+    backend = fake_ee.install(fake_ee.Backend(speedup=speedup, failures=failures, rpc_latency=rpc_latency,
+                                              slots=slots))
+    backend.queue_latency = _uniform(queue_latency, backend)
+    backend.task_duration = _uniform(task_duration, backend)
+    for index in range(tiles):
+        name = f'bench/raw/ccdc_result_{index}'
+        backend.assets[name] = {'type': 'IMAGE', 'name': name}
+    # Histogram of the `_{year}` suffixes of the handler outputs, as asked for by _mosiac
+    backend.info_handlers['aggregate_histogram'] = lambda obj: collections.Counter(
+        name[-4:] for name in backend.assets if name.startswith('bench/tmp/'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import scheduler
+        import utils
+        import ccdc_result_handler
+        scheduler.time = backend.clock
+        ccdc_result_handler.ccdc_result_handler('bench/raw', 'bench/out', 'bench/tmp', max_threads=8,
+                                                start_year=2019, end_year=2019 + years - 1, max_exports=max_exports,
+                                                multi_year=multi_year, array_extraction=array_extraction)
+        utils.LOG_WRITER.close()
+
+    stats = backend.stats()
+    completed = stats['states'].get('COMPLETED', 0)
+    makespan = stats['makespan_seconds']
+    return {
+        'tiles': tiles,
+        'exports_completed': completed,
+        'task_states': stats['states'],
+        'makespan_hours': round(makespan / 3600, 3),
+        'tiles_per_hour': round(completed / (makespan / 3600), 2) if makespan else 0.0,
+        'rpc_total': sum(stats['rpc_counts'].values()),
+        'rpc_counts': stats['rpc_counts'],
+        'mean_in_flight': round(stats['busy_seconds'] / makespan, 2) if makespan else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, from {list(SCENARIOS)}. Defaults to all.')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        scenario = dict(SCENARIOS[args.run])
+        pipeline = scenario.pop('pipeline', 'main')
+        if pipeline == 'handler':
+            print(json.dumps(run_handler_scenario(**scenario)))
+        elif pipeline == 'incremental':
+            print(json.dumps(run_incremental_scenario(**scenario)))
+        else:
+            print(json.dumps(run_main_scenario(**scenario)))
+        return
+    for name in args.scenarios or SCENARIOS:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario [{name}]')
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', name], capture_output=True,
+                             text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f'[{name}]')
+        for key, value in result.items():
+            print(f'    {key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
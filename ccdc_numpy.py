@@ -0,0 +1,273 @@
+"""
+ccdc_numpy.py
+Local CCDC over NumPy pixel stacks, for running the change detection on our own cores instead of EE.
+
+The segmentation follows `ee.Algorithms.TemporalSegmentation.Ccdc`: a harmonic model (intercept, slope and up to three
+harmonics) is fitted by ordinary least squares from minObservations clear observations spanning minNumOfYearsScaler
+years, and a break is found once minObservations consecutive observations deviate from it beyond the chi-square
+threshold summed over all bands. A first deviating observation which is not followed by enough others is dropped as an
+outlier. Unlike EE the models are not Lasso fits and the RMSE is not floored by a variogram.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+NUM_SEGMENTS = 10  # Segments kept per pixel, as many as `main.ccdc_result_flaten` pads to
+NUM_COEFS = 8  # Intercept, slope and 3 harmonic pairs
+
+_INIT = 0
+_MONITOR = 1
+_DONE = 2
+
+
+def _chi2_cdf(x: float, dof: float) -> float:
+    # Regularized lower incomplete gamma P(dof / 2, x / 2), by its power series
+    a, z = dof / 2, x / 2
+    if z <= 0:
+        return 0.0
+    term = total = 1 / a
+    n = 1
+    while term > total * 1e-15:
+        term *= z / (a + n)
+        total += term
+        n += 1
+    return min(1.0, total * math.exp(-z + a * math.log(z) - math.lgamma(a)))
+
+
+def chi2_ppf(p: float, dof: float) -> float:
+    """Get the chi-square quantile, the threshold CCDC compares the summed normalized residuals with.
+
+    Args:
+        p (float): Probability, chiSquareProbability.
+        dof (float): Degrees of freedom, the number of bands.
+
+    Returns:
+        float:
+
+    Examples:
+        >>> round(chi2_ppf(0.99, 6), 3)
+        16.812
+        >>> round(chi2_ppf(0.999, 6), 3)
+        22.458
+    """
+    low, high = 0.0, 1.0
+    while _chi2_cdf(high, dof) < p:
+        high *= 2
+    for _ in range(100):
+        mid = (low + high) / 2
+        if _chi2_cdf(mid, dof) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def flat_band_names(band_names: list[str], num_segments: int = NUM_SEGMENTS) -> list[str]:
+    """Get the names of the flattened output bands, in the order `main.ccdc_result_flaten` produces them.
+
+    Examples:
+        >>> flat_band_names(['Red', 'NIR'], 2)
+        ['tBreak_0', 'tBreak_1', 'changeProb_0', 'changeProb_1', 'Red_magnitude_0', 'Red_magnitude_1', \
+'NIR_magnitude_0', 'NIR_magnitude_1']
+    """
+    groups = ['tBreak', 'changeProb'] + [f'{band}_magnitude' for band in band_names]
+    return [f'{group}_{i}' for group in groups for i in range(num_segments)]
+
+
+def _design(dates: np.ndarray) -> np.ndarray:
+    # Columns: intercept, slope over centered years, then cos/sin of 1 to 3 cycles a year
+    w = 2 * np.pi * dates
+    columns = [np.ones_like(dates), dates - dates.mean()]
+    for k in range(1, (NUM_COEFS - 2) // 2 + 1):
+        columns += [np.cos(k * w), np.sin(k * w)]
+    return np.stack(columns, axis=-1)
+
+
+def _fit(a: np.ndarray, xy: np.ndarray, yy: np.ndarray, n: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Fewer observations fit fewer harmonics, 3 observations per coefficient as in CCDC
+    num_coefs = np.where(n < 18, 4, np.where(n < 24, 6, NUM_COEFS))
+    used = np.arange(NUM_COEFS) < num_coefs[:, None]
+    used_2d = used[:, :, None] & used[:, None, :]
+    # Unused coefficients are pinned to 0 by an identity block
+    a = np.where(used_2d, a, 0) + np.eye(NUM_COEFS) * (~used[:, :, None] + 1e-9)
+    xy = np.where(used[:, :, None], xy, 0)
+    beta = np.linalg.solve(a, xy)
+    sse = yy - 2 * np.einsum('pkb,pkb->pb', beta, xy) + np.einsum('pkb,pkl,plb->pb', beta, a, beta)
+    rmse = np.sqrt(np.maximum(sse, 0) / np.maximum(n - num_coefs, 1)[:, None])
+    return beta, np.maximum(rmse, 1e-6)
+
+
+def _segment_chunk(stack: np.ndarray, dates: np.ndarray, min_observations: int, threshold: float,
+                   min_years: float, max_iterations: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Segment a (time, band, pixel) stack, all pixels advance through their observations in lockstep.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: tBreak and changeProb (pixel, segment), magnitudes
+            (pixel, segment, band).
+    """
+    num_times, num_bands, num_pixels = stack.shape
+    x = _design(dates)
+    valid = np.all(np.isfinite(stack), axis=1).T
+    n_valid = valid.sum(axis=1)
+    # Clear observations of every pixel first, in time order
+    order = np.argsort(~valid, axis=1, kind='stable')
+    xv = x[order]
+    yv = np.nan_to_num(np.take_along_axis(stack.transpose(2, 0, 1), order[:, :, None], axis=1))
+    tv = dates[order]
+    positions = np.arange(num_times)
+    in_series = positions < n_valid[:, None]
+
+    t_break = np.zeros((num_pixels, NUM_SEGMENTS))
+    change_prob = np.zeros((num_pixels, NUM_SEGMENTS))
+    magnitude = np.zeros((num_pixels, NUM_SEGMENTS, num_bands))
+    num_segments = np.zeros(num_pixels, dtype=int)
+    state = np.full(num_pixels, _INIT)
+    start = np.zeros(num_pixels, dtype=int)
+    end = np.full(num_pixels, -1)
+    a = np.zeros((num_pixels, NUM_COEFS, NUM_COEFS))
+    xy = np.zeros((num_pixels, NUM_COEFS, num_bands))
+    yy = np.zeros((num_pixels, num_bands))
+    n = np.zeros(num_pixels, dtype=int)
+
+    def record(pixels: np.ndarray, breaks: np.ndarray, probs: np.ndarray, magnitudes: np.ndarray):
+        keep = num_segments[pixels] < NUM_SEGMENTS
+        pixels, slots = pixels[keep], num_segments[pixels[keep]]
+        t_break[pixels, slots] = breaks[keep]
+        change_prob[pixels, slots] = probs[keep]
+        magnitude[pixels, slots] = magnitudes[keep]
+        num_segments[pixels] += 1
+
+    for _ in range(max_iterations):
+        idx = np.nonzero(state == _INIT)[0]
+        if idx.size:
+            # Initial window: min_observations observations spanning min_years at least
+            s = start[idx]
+            span_ok = (tv[idx] >= (tv[idx, s] + min_years)[:, None]) & in_series[idx]
+            e = np.maximum(s + min_observations - 1, np.where(span_ok.any(axis=1), span_ok.argmax(axis=1), num_times))
+            enough = e < n_valid[idx]
+            state[idx[~enough]] = _DONE
+            idx, s, e = idx[enough], s[enough], e[enough]
+            window = ((positions >= s[:, None]) & (positions <= e[:, None])).astype(float)
+            a[idx] = np.einsum('pt,ptk,ptl->pkl', window, xv[idx], xv[idx])
+            xy[idx] = np.einsum('pt,ptk,ptb->pkb', window, xv[idx], yv[idx])
+            yy[idx] = np.einsum('pt,ptb->pb', window, yv[idx] ** 2)
+            n[idx] = e - s + 1
+            end[idx] = e
+            state[idx] = _MONITOR
+
+        idx = np.nonzero(state == _MONITOR)[0]
+        if not idx.size:
+            break
+        beta, rmse = _fit(a[idx], xy[idx], yy[idx], n[idx])
+        upcoming = end[idx, None] + 1 + np.arange(min_observations)
+        available = upcoming < n_valid[idx, None]
+        upcoming = np.minimum(upcoming, num_times - 1)
+        residuals = yv[idx[:, None], upcoming] - np.einsum('pmk,pkb->pmb', xv[idx[:, None], upcoming], beta)
+        scores = ((residuals / rmse[:, None, :]) ** 2).sum(axis=-1)
+        anomalous = (scores > threshold) & available
+        run = np.cumprod(anomalous, axis=1).sum(axis=1)
+        full = available.all(axis=1)
+
+        # Break: min_observations consecutive anomalies
+        brk = full & (run == min_observations)
+        if brk.any():
+            pixels = idx[brk]
+            record(pixels, tv[pixels, end[pixels] + 1], np.ones(pixels.size), np.median(residuals[brk], axis=1))
+            start[pixels] = end[pixels] + 1
+            state[pixels] = _INIT
+
+        # End of the series: the last segment keeps the fraction of anomalies as its change probability
+        tail = ~full
+        if tail.any():
+            pixels = idx[tail]
+            tail_run = run[tail]
+            leading = np.arange(min_observations) < tail_run[:, None]
+            magnitudes = np.zeros((pixels.size, num_bands))
+            some = tail_run > 0
+            if some.any():
+                masked = np.where(leading[some][:, :, None], residuals[tail][some], np.nan)
+                magnitudes[some] = np.nanmedian(masked, axis=1)
+            record(pixels, np.zeros(pixels.size), tail_run / min_observations, magnitudes)
+            state[pixels] = _DONE
+
+        # Otherwise take the next observation into the model, or drop it as an outlier
+        extend = ~brk & ~tail
+        include = extend & ~anomalous[:, 0]
+        pixels = idx[include]
+        nxt = end[pixels] + 1
+        x_next, y_next = xv[pixels, nxt], yv[pixels, nxt]
+        a[pixels] += x_next[:, :, None] * x_next[:, None, :]
+        xy[pixels] += x_next[:, :, None] * y_next[:, None, :]
+        yy[pixels] += y_next ** 2
+        n[pixels] += 1
+        end[idx[extend]] += 1
+    return t_break, change_prob, magnitude
+
+
+def ccdc(stack: np.ndarray, dates: np.ndarray, band_names: list[str], minObservations: int = 6,
+         chiSquareProbability: float = 0.99, minNumOfYearsScaler: float = 1.33, dateFormat: int = 1,
+         maxIterations: int = 25000, processes: int = None, chunk_pixels: int = 1024) -> dict[str, np.ndarray]:
+    """Run CCDC over a pixel stack.
+
+    The keyword arguments mirror `ee.Algorithms.TemporalSegmentation.Ccdc`. Pixels are segmented in chunks of
+    chunk_pixels, spread over a pool of processes.
+
+    Args:
+        stack (np.ndarray): (time, band, y, x) observations, NaN where masked.
+        dates (np.ndarray): (time,) observation dates as fractional years.
+        band_names (list[str]): Names of the bands of the stack.
+        minObservations (int): Number of observations needed to start a model, or to flag a change. Defaults to 6.
+        chiSquareProbability (float): Probability of the change threshold. Defaults to 0.99.
+        minNumOfYearsScaler (float): Years an initial model must span at least. Defaults to 1.33.
+        dateFormat (int): Only 1, fractional years, is supported.
+        maxIterations (int): Maximum number of monitoring steps per chunk. Defaults to 25000.
+        processes (int): Number of worker processes, 1 runs in this process. Defaults to the number of CPUs.
+        chunk_pixels (int): Number of pixels segmented together. Defaults to 1024.
+
+    Returns:
+        dict[str, np.ndarray]: (y, x) image of every flattened band, named and ordered as `flat_band_names`.
+
+    Examples:
+        >>> dates = np.arange(2018, 2023, 1 / 23)
+        >>> noise = np.random.default_rng(0).normal(0, 0.005, (dates.size, 2, 1, 2))
+        >>> season = 0.02 * np.sin(2 * np.pi * dates)[:, None, None, None]
+        >>> step = np.array([0.0, 0.2])[None, None, None, :] * (dates >= 2020.5)[:, None, None, None]
+        >>> res = ccdc(0.1 + season + step + noise, dates, ['Red', 'NIR'], processes=1)
+        >>> [round(float(v), 2) for v in res['tBreak_0'][0]], [float(v) for v in res['changeProb_0'][0]]
+        ([0.0, 2020.52], [0.0, 1.0])
+        >>> round(float(res['NIR_magnitude_0'][0, 1]), 1)
+        0.2
+    """
+    if dateFormat != 1:
+        raise ValueError(f'Only dateFormat 1 (fractional years) is supported, got [{dateFormat}]')
+    num_times, num_bands, height, width = stack.shape
+    flat = stack.reshape(num_times, num_bands, height * width).astype(float)
+    dates = np.asarray(dates, dtype=float)
+    segment = partial(_segment_chunk, dates=dates, min_observations=minObservations,
+                      threshold=chi2_ppf(chiSquareProbability, num_bands), min_years=minNumOfYearsScaler,
+                      max_iterations=maxIterations)
+    chunks = [flat[:, :, i:i + chunk_pixels] for i in range(0, height * width, chunk_pixels)]
+    if processes == 1 or len(chunks) == 1:
+        results = [segment(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(segment, chunks))
+    t_break = np.concatenate([r[0] for r in results]).reshape(height, width, NUM_SEGMENTS)
+    change_prob = np.concatenate([r[1] for r in results]).reshape(height, width, NUM_SEGMENTS)
+    magnitude = np.concatenate([r[2] for r in results]).reshape(height, width, NUM_SEGMENTS, num_bands)
+    ret = {}
+    for i in range(NUM_SEGMENTS):
+        ret[f'tBreak_{i}'] = t_break[:, :, i]
+    for i in range(NUM_SEGMENTS):
+        ret[f'changeProb_{i}'] = change_prob[:, :, i]
+    for b, band in enumerate(band_names):
+        for i in range(NUM_SEGMENTS):
+            ret[f'{band}_magnitude_{i}'] = magnitude[:, :, i, b]
+    return ret
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
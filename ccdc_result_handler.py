@@ -1,7 +1,44 @@
 import ee
+import os
 import threading
 import utils
 import time
+from concurrent.futures import Future, wait
+from scheduler import ConcurrencyController, ExportScheduler
+from asset_catalog import AssetCatalog
+from geometry import BBox
+import pixel_sink
+import quadkey
+
+ASSET_CATALOG_PATH = './cache/asset_catalog.json'
+
+
+def _asset_names(parent: str, catalog: AssetCatalog = None) -> set[str]:
+    if catalog:
+        return catalog.names(parent)
+    return {name.split('/')[-1] for name in utils.iter_asset_names(parent)}
+
+
+def patch_filter(image: ee.Image, min_patch_size: int) -> ee.Image:
+    """Mask out patches of equal break year smaller than min_patch_size pixels.
+
+    Args:
+        image (ee.Image): Yearly change image with a `tBreak` band.
+        min_patch_size (int): Minimum number of 8-connected pixels a patch needs to be kept.
+
+    Returns:
+        ee.Image: The masked image.
+    """
+    image_int = ee.Image(image).select('tBreak').toInt32()
+    labels = image_int.connectedComponents(
+        connectedness=ee.Kernel.circle(1),
+        maxSize=1024,
+    ).select(['labels'])
+    patch_size = labels.connectedPixelCount(
+        maxSize=1024,
+        eightConnected=True,
+    )
+    return ee.Image(image).updateMask(patch_size.gte(min_patch_size))
 
 
 class _HandlerThread(threading.Thread):
@@ -9,7 +46,7 @@ class _HandlerThread(threading.Thread):
     ccdc_res_list: list
     res_list_lock = threading.Lock()
     out_path: str
-    out_path_exists_list: list
+    out_path_exists_list: set
     bands_basename = [
         'tBreak', 'Blue_magnitude', 'Green_magnitude', 'Red_magnitude', 'NIR_magnitude', 'SWIR1_magnitude',
         'SWIR2_magnitude', 'changeProb'
@@ -21,6 +58,14 @@ class _HandlerThread(threading.Thread):
     start_time: time.struct_time
     end_time: time.struct_time
     min_patch_size: int = 16
+    scheduler: ExportScheduler
+    export_attempts: int = 3
+    futures: list[Future] = []
+    multi_year: bool = False
+    array_extraction: bool = False
+    mosaic_patch_filter: bool = False
+    catalog: AssetCatalog = None
+    local_dir: str = None
 
     def __init__(self):
         super().__init__()
@@ -31,17 +76,7 @@ class _HandlerThread(threading.Thread):
             return self.ccdc_res_list == []
 
     def _patch_cal(self, image: ee.Image) -> ee.Image:
-        image_int = ee.Image(image).select('tBreak').toInt32()
-        labels = image_int.connectedComponents(
-            connectedness=ee.Kernel.circle(1),
-            maxSize=1024,
-        ).select(['labels'])
-        patch_size = labels.connectedPixelCount(
-            maxSize=1024,
-            eightConnected=True,
-        )
-        image = ee.Image(image).updateMask(patch_size.gte(self.min_patch_size))
-        return image
+        return patch_filter(image, self.min_patch_size)
 
     @staticmethod
     def _get_image_interval(bands: dict, year: int) -> ee.Image:
@@ -66,10 +101,48 @@ class _HandlerThread(threading.Thread):
             res = res.addBands(ee.Image(it))
         return res
 
-    def _run_inner(self, image: ee.Image, image_name: str) -> None:
+    @classmethod
+    def _get_image_interval_array(cls, image: ee.Image, year: int) -> ee.Image:
+        """Array version of `_get_image_interval`.
+
+        All band groups are stacked into one (segment, group) array per pixel. The first segment whose break falls in
+        the year with a change probability above the threshold is picked with one sort and slice. When several breaks
+        fall in the same year this keeps the earliest one, instead of taking the per-band median of them.
+        """
+        segments = ee.Image.cat([
+            image.select(cls.bands_names[key]).toArray().toArray(1) for key in cls.bands_basename
+        ]).toArray(1)
+        t_break_index = cls.bands_basename.index('tBreak')
+        change_prob_index = cls.bands_basename.index('changeProb')
+        t_break = segments.arraySlice(1, t_break_index, t_break_index + 1)
+        change_prob = segments.arraySlice(1, change_prob_index, change_prob_index + 1)
+        in_year = t_break.gte(year).And(t_break.lt(year + 1)).And(change_prob.gte(cls.change_prob_threshold))
+        # In-year segments first, each group kept in segment order
+        segment_index = ee.Image(ee.Array(list(range(cls.base_band_len)))).toArray(1)
+        order = in_year.Not().multiply(cls.base_band_len).add(segment_index)
+        found = in_year.arrayReduce(ee.Reducer.max(), [0]).arrayGet([0, 0])
+        res = segments.arraySort(order).arraySlice(0, 0, 1).arrayProject([1]).arrayFlatten([cls.bands_basename])
+        return res.updateMask(found)
+
+    def _year_image(self, image: ee.Image, masked_bands: dict, year: int) -> ee.Image:
+        if self.array_extraction:
+            cur_image = self._get_image_interval_array(image, year)
+        else:
+            cur_image = self._get_image_interval(masked_bands, year)
+        if self.mosaic_patch_filter:
+            # Patches are filtered on the yearly mosaic, so the ones crossing tile seams keep their full size
+            return cur_image
+        return self._patch_cal(cur_image)
+
+    def _run_inner(self, image: ee.Image, image_name: str, years: list[int] = None) -> None:
         start_time = self.start_time.tm_year
         end_time = self.end_time.tm_year
+        if years is None:
+            years = range(start_time, end_time + 1)
         bounds = image.geometry().bounds()
+        if self.local_dir:
+            # Downloads need the pixel grid on the client
+            bounds = BBox.from_geojson(bounds.getInfo())
         change_prob = image.select(self.bands_names['changeProb'])
         t_break = image.select(self.bands_names['tBreak'])
         prob_mask = change_prob.gte(self.change_prob_threshold)
@@ -77,42 +150,76 @@ class _HandlerThread(threading.Thread):
             key: image.select(self.bands_names[key]).updateMask(prob_mask)
             for key in self.bands_basename
         }
-        for year in range(start_time, end_time + 1):
+        if self.multi_year:
+            if image_name in self.out_path_exists_list:
+                return
+            year_images = []
+            band_names = []
+            for year in range(start_time, end_time + 1):
+                cur_image = self._year_image(image, masked_bands, year)
+                year_images.append(cur_image.rename([f'{year}_{key}' for key in self.bands_basename]))
+                band_names += [f'{year}_{key}' for key in self.bands_basename]
+            self._export(ee.Image.cat(year_images), image_name, bounds, band_names)
+            return
+        for year in years:
             file_name = f'{image_name}_{year}'
-            asset_id =f'{self.out_path}{file_name}' if self.out_path.endswith('/') else f'{self.out_path}/{file_name}'
             if file_name in self.out_path_exists_list:
                 continue
-            cur_image = self._get_image_interval(masked_bands, year)
-            cur_image = self._patch_cal(cur_image)
-            while True:
-                task = ee.batch.Export.image.toAsset(
-                    image=cur_image,
-                    description='export_' + file_name,
-                    assetId= asset_id,
-                    scale=10,
-                    maxPixels=1e13,
-                    region=bounds,
-                    crs='EPSG:4326',
-                )
-                if utils.start_task_and_monitoring(task):
-                    break
+            cur_image = self._year_image(image, masked_bands, year)
+            self._export(cur_image, file_name, bounds)
+
+    def _export(self, image: ee.Image, file_name: str, bounds: ee.Geometry | BBox, bands: list[str] = None) -> None:
+        if self.local_dir:
+            if not pixel_sink.download_image(image, os.path.join(self.local_dir, file_name), quadkey.snap(bounds),
+                                             bands or self.bands_basename):
+                utils.log_err(f'Failed to download {file_name}', tile=file_name)
+            return
+        asset_id = f'{self.out_path}{file_name}' if self.out_path.endswith('/') else f'{self.out_path}/{file_name}'
+
+        def make_task() -> ee.batch.Task:
+            return ee.batch.Export.image.toAsset(
+                image=image,
+                description='export_' + file_name,
+                assetId=asset_id,
+                maxPixels=1e13,
+                region=bounds,
+                crs='EPSG:4326',
+                crsTransform=quadkey.CRS_TRANSFORM,
+            )
+
+        future = self.scheduler.submit(make_task, self.export_attempts, file_name)
+        if self.catalog:
+            catalog = self.catalog
+
+            def record(done: Future):
+                if done.result():
+                    catalog.add(asset_id)
+
+            future.add_done_callback(record)
+        with _HandlerThread.res_list_lock:
+            _HandlerThread.futures.append(future)
 
     def run(self):
         while not self._is_empty():
             with self.res_list_lock:
                 res = self.ccdc_res_list.pop(0)
             image = ee.Image(res['name'])
-            self._run_inner(image, res['name'].split('/')[-1])
+            self._run_inner(image, res['name'].split('/')[-1], res['years'])
 
     @classmethod
     def set_attribute(cls, ccdc_res_path: str = None, out_path: str = None, max_threads: int = 1,
-                      change_prob_threshold: float = 0.95, **kwargs):
+                      change_prob_threshold: float = 0.95, scheduler: ExportScheduler = None,
+                      work: dict[str, list[int]] = None, catalog: AssetCatalog = None, **kwargs):
         """
         Args:
             ccdc_res_path (str):
             out_path (str):
             max_threads (int):
             change_prob_threshold (float):
+            scheduler (ExportScheduler): Shared scheduler the exports are handed to.
+            work (dict[str, list[int]]): Years to export per CCDC result, as returned by `_fill_tmp_finished`. Defaults
+                to every result and year not yet in out_path.
+            catalog (AssetCatalog): Cache of the asset listings, kept up to date with the finished exports.
             **kwargs:
 
         Keyword Args:
@@ -121,6 +228,10 @@ class _HandlerThread(threading.Thread):
             time_format (str):
             change_prob_threshold (int):
             min_patch_size (int):
+            multi_year (bool):
+            array_extraction (bool):
+            mosaic_patch_filter (bool):
+            local_dir (str): Download the images into this directory instead of exporting them to out_path.
         """
         if ccdc_res_path:
             cls.ccdc_res = ee.ImageCollection(ccdc_res_path)
@@ -128,8 +239,16 @@ class _HandlerThread(threading.Thread):
             cls.out_path = out_path
         if max_threads:
             cls.max_threads = max_threads
-        cls.ccdc_res_list = ee.data.listAssets(ccdc_res_path)['assets']
-        cls.out_path_exists_list = [item['name'].split('/')[-1] for item in ee.data.listAssets(out_path)['assets']]
+        if scheduler:
+            cls.scheduler = scheduler
+        cls.catalog = catalog
+        cls.local_dir = kwargs.get('local_dir')
+        if work is None:
+            work = {name: None for name in _asset_names(ccdc_res_path, catalog)}
+            cls.out_path_exists_list = _asset_names(out_path, catalog)
+        else:
+            cls.out_path_exists_list = set()
+        cls.ccdc_res_list = [{'name': f'{ccdc_res_path}/{tile}', 'years': years} for tile, years in work.items()]
         cls.change_prob_threshold = change_prob_threshold
         if kwargs:
             if 'start_time' in kwargs and 'time_format' in kwargs:
@@ -140,6 +259,12 @@ class _HandlerThread(threading.Thread):
                 cls.change_prob_threshold = kwargs['change_prob_threshold']
             if 'min_patch_size' in kwargs:
                 cls.min_patch_size = kwargs['min_patch_size']
+            if 'multi_year' in kwargs:
+                cls.multi_year = kwargs['multi_year']
+            if 'array_extraction' in kwargs:
+                cls.array_extraction = kwargs['array_extraction']
+            if 'mosaic_patch_filter' in kwargs:
+                cls.mosaic_patch_filter = kwargs['mosaic_patch_filter']
 
     @classmethod
     def run_all(cls):
@@ -170,66 +295,128 @@ class _HandlerThread(threading.Thread):
             time.sleep(0.5)
         for t in threads:
             t.join(timeout=0.1)
+        with cls.res_list_lock:
+            futures, cls.futures = cls.futures, []
+        wait(futures)
 
 
-def _mosiac(out_path: str, tmp_path: str, aoi_path: str, start_year: int, end_year: int) -> None:
+def _mosiac(out_path: str, tmp_path: str, aoi_path: str, start_year: int, end_year: int,
+            multi_year: bool = False, min_patch_size: int = None, catalog: AssetCatalog = None,
+            max_exports: int = 4, max_attempts: int = 3, rebuild: bool = False) -> list[int]:
+    """Mosaic the per-result outputs in tmp_path into one image per year.
+
+    The exports are tracked by their own ExportScheduler, which runs at most max_exports of them at once and starts
+    each up to max_attempts times, and are waited for. Years whose mosaic exists are skipped, unless rebuild is set,
+    then the existing mosaics are deleted and exported again.
+
+    Returns:
+        list[int]: Years whose mosaic could not be exported.
+    """
     ic = ee.ImageCollection(tmp_path)
-    res_exists_l = [item['name'].split('/')[-1] for item in ee.data.listAssets(out_path)['assets']]
     if aoi_path:
         aoi = ee.FeatureCollection(aoi_path).geometry()
     else:
         aoi = ic.geometry().bounds()
     try:
-        existing = ee.data.listAssets(out_path).get('assets', [])
-        existing_names = {item['name'].split('/')[-1] for item in existing}
+        existing_names = _asset_names(out_path, catalog)
     except Exception:
         existing_names = set()
-    for year in range(start_year, end_year + 1):
+    years = [year for year in range(start_year, end_year + 1)
+             if rebuild or f'ccdc_result_{year}' not in existing_names]
+    if not multi_year and years:
+        # Years present in tmp_path, from the `_{year}` suffix of every output, in one request
+        year_histogram = ic.map(
+            lambda image: image.set('year', ee.String(image.get('system:index')).slice(-4))
+        ).aggregate_histogram('year').getInfo()
+        years = [year for year in years if str(year) in year_histogram]
+    scheduler = ExportScheduler(max_exports)
+    futures = {}
+    for year in years:
         file_name = f'ccdc_result_{year}'
-        year_int = int(year)
-        if file_name in existing_names:
-            continue
-        subset = ic.filter(ee.Filter.stringEndsWith('system:index', f'_{year}')).sort('system:index')
-        if ee.Number(subset.size()).eq(0).getInfo():
-            continue
-        img = subset.mosaic().set({'year': year})
         asset_id = f'{out_path}{file_name}' if out_path.endswith('/') else f'{out_path}/{file_name}'
+        if file_name in existing_names:
+            # Only when rebuilding, an export cannot overwrite the stale mosaic
+            try:
+                ee.data.deleteAsset(asset_id)
+            except ee.EEException as e:
+                utils.log_err(f'Failed to delete the mosaic {asset_id}: {e}')
+            if catalog:
+                catalog.remove(asset_id)
+        if multi_year:
+            year_bands = [f'{year}_{key}' for key in _HandlerThread.bands_basename]
+            subset = ic.sort('system:index').map(
+                lambda image: image.select(year_bands).rename(_HandlerThread.bands_basename))
+        else:
+            subset = ic.filter(ee.Filter.stringEndsWith('system:index', f'_{year}')).sort('system:index')
+        img = subset.mosaic()
+        if min_patch_size:
+            img = patch_filter(img, min_patch_size)
+        img = img.set({'year': year})
         time_start = ee.Date(f'{year}-01-01T00:00:00')
         time_end = ee.Date(f'{year + 1}-1-1T00:00:00')
         img = img.set('system:time_start', time_start.millis()).set('system:time_end', time_end.millis())
-        if file_name in res_exists_l:
+
+        def make_task(img=img, file_name=file_name, asset_id=asset_id) -> ee.batch.Task:
+            return ee.batch.Export.image.toAsset(
+                image=img,
+                description='export_' + file_name,
+                assetId=asset_id,
+                maxPixels=1e13,
+                region=aoi,
+                crs='EPSG:4326',
+                crsTransform=quadkey.CRS_TRANSFORM,
+            )
+
+        futures[year] = (scheduler.submit(make_task, max_attempts, file_name), asset_id)
+    scheduler.shutdown()
+    failed = []
+    for year, (future, asset_id) in futures.items():
+        if not future.result():
+            failed.append(year)
+        elif catalog:
+            catalog.add(asset_id)
+    if failed:
+        utils.log_err(f'Mosaic of {failed} could not be exported')
+    return failed
+
+
+def _fill_tmp_finished(res_path: str, tmp_path: str, start_year: int, end_year: int,
+                       multi_year: bool = False, catalog: AssetCatalog = None,
+                       local_dir: str = None) -> dict[str, list[int]]:
+    """Find the yearly outputs still missing from tmp_path, or from the finished stores in local_dir if it's given.
+
+    Returns:
+        dict[str, list[int]]: Missing years per CCDC result name, empty once tmp_path is complete. In multi_year mode
+            every year of a missing result is listed.
+    """
+    tmp_names = pixel_sink.finished_stores(local_dir) if local_dir else _asset_names(tmp_path, catalog)
+    years = list(range(start_year, end_year + 1))
+    missing = {}
+    for item in sorted(_asset_names(res_path, catalog)):
+        if multi_year:
+            if item not in tmp_names:
+                missing[item] = years
             continue
-        task = ee.batch.Export.image.toAsset(
-            image=img,
-            description='export_' + file_name,
-            assetId=asset_id,
-            scale=10,
-            maxPixels=1e13,
-            region=aoi,
-            crs='EPSG:4326',
-        )
-        task.start()
-
-
-def _fill_tmp_finished(res_path: str, tmp_path: str, start_year: int, end_year: int) -> bool:
-    ret = True
-    raw_list = [item['name'].split('/')[-1] for item in ee.data.listAssets(res_path)['assets']]
-    tmp_list = [item['name'].split('/')[-1] for item in ee.data.listAssets(tmp_path)['assets']]
-    for item in raw_list:
-        for year in range(start_year, end_year + 1):
-            if f'{item}_{year}' not in tmp_list:
-                print(f'{item}_{year} is missing')
-                ret = False
-    return ret
+        item_missing = [year for year in years if f'{item}_{year}' not in tmp_names]
+        if item_missing:
+            missing[item] = item_missing
+    if missing:
+        utils.log(f'{sum(len(v) for v in missing.values())} outputs of {len(missing)} results are missing')
+    return missing
 
 
 def ccdc_result_handler(res_path: str, out_path: str, tmp_path: str = None, aoi_path: str = None,
-                        max_threads: int = 1, start_year: int = None, end_year: int = None) -> None:
+                        max_threads: int = 1, start_year: int = None, end_year: int = None,
+                        max_exports: int = 32, min_exports: int = 4, multi_year: bool = False,
+                        array_extraction: bool = False, mosaic_patch_filter: bool = False,
+                        local_dir: str = None, rebuild_mosaics: bool = False) -> None:
     """Handle with CCDC result.
 
     This method will create max_thread threads to process each CCDC result and temporarily store the outputs in the
-    tmp_path directory. Finally, the results will be mosaicked into a single image and saved to out_path. The tmp_path
-    directory will be automatically created and deleted within the function to ensure it is empty.
+    tmp_path directory. The threads only build the yearly images, their exports are handed to a shared scheduler which
+    keeps up to max_exports of them in flight. Finally, the results will be mosaicked into a single image and saved to
+    out_path. The tmp_path directory will be automatically created and deleted within the function to ensure it is
+    empty.
 
     Args:
         res_path (str): Path to the CCDC result directory or image collection.
@@ -238,17 +425,60 @@ def ccdc_result_handler(res_path: str, out_path: str, tmp_path: str = None, aoi_
             within.
         max_threads (int): Maximum number of threads to process each CCDC result and temporarily store the output.
             Defaults to 1.
+        max_exports (int): Maximum number of export tasks in flight. Defaults to 32.
+        min_exports (int): Number of export tasks in flight the limit never drops below. The limit starts halfway
+            up to max_exports and adapts to EE queue latency and failures. Defaults to 4.
+        multi_year (bool): Export one asset per CCDC result holding every year, with bands named
+            `{year}_{band}`, instead of one asset per result and year. Defaults to False.
+        array_extraction (bool): Pick the yearly change from a (segment, group) array in one pass instead of taking
+            per-band medians of single-band image collections. Defaults to False.
+        mosaic_patch_filter (bool): Drop the small patches once per year on the mosaic rather than on every result, so
+            patches crossing tile seams are measured whole. Defaults to False.
+        local_dir (str): Download the yearly images of every result into `{local_dir}/{name}_{year}` with
+            computePixels, instead of exporting them to tmp_path and mosaicking them. Outputs whose store is already
+            complete are skipped and failed downloads are resumed until a round finishes none. Defaults to None.
+        rebuild_mosaics (bool): Export the yearly mosaics again even if they exist, after CCDC results changed, e.g.
+            in an incremental run of main.py. Defaults to False.
         aoi_path (str): Path to the area of interest. Defaults to None. If it's None, won't clip.
         start_year (int):
         end_year (int):
     """
     res_path = res_path.rstrip('/')
     out_path = out_path.rstrip('/')
-    while not _fill_tmp_finished(res_path, tmp_path, start_year, end_year):
-        _HandlerThread.set_attribute(res_path, tmp_path, max_threads, start_time=f'{start_year}', end_time=f'{end_year}',
-                                     time_format='%Y', )
+    controller = ConcurrencyController(max(min_exports, max_exports // 2), min_exports, max_exports)
+    scheduler = ExportScheduler(max_exports, controller=controller)
+    catalog = AssetCatalog(ASSET_CATALOG_PATH)
+    # Raw exports of main.py and deletions made elsewhere never reach the catalog, list the inputs once per call
+    for path in (res_path, tmp_path):
+        if path:
+            catalog.names(path, refresh=True)
+    missing = _fill_tmp_finished(res_path, tmp_path, start_year, end_year, multi_year, catalog, local_dir)
+    while missing:
+        if local_dir:
+            _HandlerThread.set_attribute(res_path, None, max_threads, work=missing, local_dir=local_dir,
+                                         start_time=f'{start_year}', end_time=f'{end_year}', time_format='%Y',
+                                         multi_year=multi_year, array_extraction=array_extraction,
+                                         mosaic_patch_filter=False)
+        else:
+            _HandlerThread.set_attribute(res_path, tmp_path, max_threads, scheduler=scheduler, work=missing,
+                                         catalog=catalog, start_time=f'{start_year}', end_time=f'{end_year}',
+                                         time_format='%Y', multi_year=multi_year,
+                                         array_extraction=array_extraction, mosaic_patch_filter=mosaic_patch_filter)
         _HandlerThread.run_all()
-    _mosiac(out_path, tmp_path, aoi_path, start_year, end_year)
+        left = _fill_tmp_finished(res_path, tmp_path, start_year, end_year, multi_year, catalog, local_dir)
+        # Exports are retried by the scheduler and downloads resume their stores, stop once a round finishes none
+        if sum(len(v) for v in left.values()) >= sum(len(v) for v in missing.values()):
+            utils.log_err(f'{"Downloads" if local_dir else "Exports"} of {sum(len(v) for v in left.values())} '
+                          f'outputs failed: {", ".join(sorted(left))}')
+            break
+        missing = left
+    scheduler.shutdown()
+    if local_dir:
+        return
+    min_patch_size = _HandlerThread.min_patch_size if mosaic_patch_filter else None
+    _mosiac(out_path, tmp_path, aoi_path, start_year, end_year, multi_year, min_patch_size, catalog,
+            rebuild=rebuild_mosaics)
+    catalog.flush()
 
 
 if __name__ == '__main__':
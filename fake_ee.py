@@ -0,0 +1,543 @@
+"""
+fake_ee.py
+A local, in-process stand-in for the parts of the Earth Engine API used by this project, so the orchestration in main.py
+and ccdc_result_handler.py can run and be benchmarked without an EE account.
+
+Computed objects only record how they were built, `getInfo` answers through `Backend.info_handlers`. Export tasks go
+through READY and RUNNING on a scaled clock and then complete, creating their asset, or fail with an injected error.
+
+Usage:
+    import fake_ee
+    backend = fake_ee.install(fake_ee.Backend(speedup=600))
+    import main  # `import ee` now resolves to this module
+    main.time = backend.clock  # let the polling loops sleep on the scaled clock
+"""
+import enum
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from typing import Callable, Optional, Union
+import numpy as np
+
+MEMORY_LIMIT_ERROR = 'User memory limit exceeded.'
+OUT_OF_MEMORY_ERROR = 'Execution failed; out of memory.'
+
+BACKEND: Optional['Backend'] = None
+
+
+class EEException(Exception):
+    pass
+
+
+class Clock:
+    """Wall clock running `speedup` times faster than real time, `sleep(s)` takes `s / speedup` real seconds."""
+
+    def __init__(self, speedup: float = 1.0):
+        self.speedup = speedup
+        self._origin = time.monotonic()
+
+    def time(self) -> float:
+        return (time.monotonic() - self._origin) * self.speedup
+
+    def monotonic(self) -> float:
+        return self.time()
+
+    def sleep(self, seconds: float):
+        time.sleep(max(seconds, 0) / self.speedup)
+
+
+class Backend:
+    def __init__(self, speedup: float = 1.0, queue_latency: Union[float, Callable] = 60.0,
+                 task_duration: Union[float, Callable] = 3600.0, failures: Union[dict, Callable] = None,
+                 rpc_latency: float = 0.0, scene_count: Union[int, Callable] = 300, pixel_failures: float = 0.0,
+                 slots: int = None, seed: int = 0):
+        """
+        Args:
+            speedup (float): How much faster than real time the simulated clock runs.
+            queue_latency (float | Callable[[Task], float]): Seconds a started task stays READY.
+            task_duration (float | Callable[[Task], float]): Seconds a task stays RUNNING.
+            failures (dict[str, float] | Callable[[Task], Optional[str]]): Error message to the probability of a task
+                failing with it, or a function giving the error message of a task, None to succeed.
+            rpc_latency (float): Seconds every RPC blocks the caller.
+            scene_count (int | Callable[[ComputedObject], int]): Answer of `size().getInfo()` on an image collection.
+            pixel_failures (float): Probability of a `computePixels` request failing.
+            slots (int): Number of tasks EE runs at once, the others wait in READY for a free slot. Unlimited if None.
+            seed (int): Seed of the random draws.
+        """
+        self.clock = Clock(speedup)
+        self.queue_latency = queue_latency
+        self.task_duration = task_duration
+        self.failures = failures or {}
+        self.rpc_latency = rpc_latency
+        self.scene_count = scene_count
+        self.pixel_failures = pixel_failures
+        self._slot_free_at = [0.0] * slots if slots else None
+        self.rpc_counts = Counter()
+        self.tasks: dict[str, dict] = {}
+        self.assets: dict[str, dict] = {}
+        self.feature_collections: dict[str, list[dict]] = {}
+        self.info_handlers: dict[str, Callable] = {
+            'size': self._size_info,
+            'FeatureCollection': self._feature_collection_info,
+            'toList': self._to_list_info,
+        }
+        self.random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._ids = itertools.count()
+
+    def rpc(self, kind: str):
+        with self._lock:
+            self.rpc_counts[kind] += 1
+        if self.rpc_latency:
+            self.clock.sleep(self.rpc_latency)
+
+    def _draw(self, value, arg):
+        return value(arg) if callable(value) else value
+
+    def _draw_error(self, task: 'Task') -> Optional[str]:
+        if callable(self.failures):
+            return self.failures(task)
+        x = self.random.random()
+        for message, probability in self.failures.items():
+            if x < probability:
+                return message
+            x -= probability
+        return None
+
+    def _size_info(self, obj: 'ComputedObject'):
+        if isinstance(obj.source, FeatureCollection):
+            return len(self._feature_collection_info(obj.source)['features'])
+        return self._draw(self.scene_count, obj.source)
+
+    def _feature_collection_info(self, obj: 'ComputedObject'):
+        features = self.feature_collections.get(obj.args[0], []) if obj.args else []
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def _to_list_info(self, obj: 'ComputedObject'):
+        if not isinstance(obj.source, FeatureCollection):
+            return None
+        count, offset = (list(obj.args) + [0])[:2]
+        return self._feature_collection_info(obj.source)['features'][offset:offset + count]
+
+    def get_info(self, obj: 'ComputedObject'):
+        self.rpc('getInfo')
+        handler = self.info_handlers.get(obj.func)
+        return handler(obj) if handler else None
+
+    def compute_pixels(self, params: dict) -> np.ndarray:
+        """Serve a synthetic block, band i of a pixel holds i plus the x coordinate of the pixel centre."""
+        self.rpc('computePixels')
+        with self._lock:
+            failed = self.random.random() < self.pixel_failures
+        if failed:
+            raise EEException('Too many concurrent aggregations.')
+        dimensions, transform = params['grid']['dimensions'], params['grid']['affineTransform']
+        x = transform['translateX'] + (np.arange(dimensions['width']) + 0.5) * transform['scaleX']
+        dtype = [(band, 'f8') for band in params['bandIds']]
+        block = np.zeros((dimensions['height'], dimensions['width']), dtype=dtype)
+        for i, band in enumerate(params['bandIds']):
+            block[band] = i + x
+        return block
+
+    # Tasks
+
+    def start_task(self, task: 'Task'):
+        self.rpc('Task.start')
+        with self._lock:
+            task.id = f'FAKE{next(self._ids):08d}'
+            now = self.clock.time()
+            running = now + self._draw(self.queue_latency, task)
+            duration = self._draw(self.task_duration, task)
+            if self._slot_free_at is not None:
+                # Tasks take the slot which frees up first, in the order they were started
+                running = max(running, heapq.heappop(self._slot_free_at))
+                heapq.heappush(self._slot_free_at, running + duration)
+            self.tasks[task.id] = {
+                'task': task,
+                'start': now,
+                'running': running,
+                'end': running + duration,
+                'error': self._draw_error(task),
+                'cancelled': None,
+                'finished': False,
+            }
+            task.state = Task.State.READY
+
+    def _refresh(self, record: dict, now: float) -> str:
+        if record['cancelled'] is not None:
+            return 'CANCELLED'
+        if now < record['running']:
+            return 'READY'
+        if now < record['end']:
+            return 'RUNNING'
+        if not record['finished']:
+            record['finished'] = True
+            asset_id = record['task'].config.get('assetId')
+            if record['error'] is None and asset_id:
+                self.assets[asset_id] = {'type': 'IMAGE', 'name': asset_id}
+        return 'FAILED' if record['error'] is not None else 'COMPLETED'
+
+    def _status(self, task_id: str, now: float) -> dict:
+        record = self.tasks[task_id]
+        state = self._refresh(record, now)
+        status = {
+            'id': task_id,
+            'name': f'projects/fake/operations/{task_id}',
+            'state': state,
+            'description': record['task'].config.get('description', ''),
+            'task_type': record['task'].task_type.value,
+            'creation_timestamp_ms': int(record['start'] * 1000),
+            'update_timestamp_ms': int(now * 1000),
+        }
+        if state != 'READY':
+            status['start_timestamp_ms'] = int(record['running'] * 1000)
+        if state == 'FAILED':
+            status['error_message'] = record['error']
+        return status
+
+    def task_status(self, task_id: str) -> dict:
+        self.rpc('Task.status')
+        with self._lock:
+            return self._status(task_id, self.clock.time())
+
+    def task_list(self) -> list[dict]:
+        self.rpc('getTaskList')
+        with self._lock:
+            now = self.clock.time()
+            return [self._status(task_id, now) for task_id in reversed(list(self.tasks))]
+
+    def cancel_task(self, task_id: str):
+        self.rpc('cancelTask')
+        with self._lock:
+            record = self.tasks[task_id]
+            if self._refresh(record, self.clock.time()) in ('READY', 'RUNNING'):
+                record['cancelled'] = self.clock.time()
+
+    def stats(self) -> dict:
+        """Summary of all tasks started so far.
+
+        `busy_seconds` adds up the READY and RUNNING time of every task, that is how long it held an EE slot.
+        """
+        with self._lock:
+            now = self.clock.time()
+            states = Counter()
+            busy, first, last = 0.0, None, None
+            for task_id, record in self.tasks.items():
+                states[self._refresh(record, now)] += 1
+                end = min(record['cancelled'] or record['end'], now)
+                busy += end - record['start']
+                first = record['start'] if first is None else min(first, record['start'])
+                last = end if last is None else max(last, end)
+            return {
+                'states': dict(states),
+                'rpc_counts': dict(self.rpc_counts),
+                'busy_seconds': busy,
+                'makespan_seconds': (last - first) if self.tasks else 0.0,
+            }
+
+    # Assets
+
+    def list_assets(self, params) -> dict:
+        self.rpc('listAssets')
+        if isinstance(params, str):
+            params = {'parent': params}
+        parent = params['parent'].rstrip('/') + '/'
+        with self._lock:
+            now = self.clock.time()
+            for record in self.tasks.values():
+                self._refresh(record, now)
+            names = sorted(name for name in self.assets if name.startswith(parent) and '/' not in name[len(parent):])
+        offset = int(params.get('pageToken') or 0)
+        page_size = int(params.get('pageSize') or len(names) or 1)
+        ret = {'assets': [{'name': name, 'type': self.assets[name]['type'], 'id': name}
+                          for name in names[offset:offset + page_size]]}
+        if 'pageSize' in params and offset + page_size < len(names):
+            ret['nextPageToken'] = str(offset + page_size)
+        return ret
+
+    def create_asset(self, value: dict, path: str):
+        self.rpc('createAsset')
+        with self._lock:
+            if path in self.assets:
+                raise EEException(f'Cannot overwrite asset \'{path}\'.')
+            self.assets[path] = {'type': value.get('type', 'FOLDER'), 'name': path}
+
+    def delete_asset(self, name: str):
+        self.rpc('deleteAsset')
+        with self._lock:
+            if self.assets.pop(name, None) is None:
+                raise EEException(f'Asset \'{name}\' does not exist or doesn\'t allow this operation.')
+
+
+class _Static(type):
+    # Static constructors such as `ee.Geometry.Rectangle` or `ee.Filter.eq` return an instance of their class
+    def __getattr__(cls, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: cls._call(f'{cls.__name__}.{name}', None, args, kwargs)
+
+
+class ComputedObject(metaclass=_Static):
+    _returns: dict[str, str] = {}
+    _element: str = 'ComputedObject'
+
+    def __init__(self, *args, **kwargs):
+        self.func = type(self).__name__
+        self.source = args[0] if args and isinstance(args[0], ComputedObject) else None
+        self.args = args
+        self.kwargs = kwargs
+
+    @classmethod
+    def _call(cls, func: str, source, args: tuple, kwargs: dict) -> 'ComputedObject':
+        obj = cls.__new__(cls)
+        obj.func, obj.source, obj.args, obj.kwargs = func, source, args, kwargs
+        return obj
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            if name in ('map', 'iterate') and args and callable(args[0]):
+                # Trace the callback once, as the EE client does when it builds the graph
+                args[0](*[_CLASSES[self._element]._call('element', None, (), {})] * (2 if name == 'iterate' else 1))
+            return _CLASSES[self._returns.get(name, type(self).__name__)]._call(name, self, args, kwargs)
+
+        return method
+
+    def getInfo(self):
+        return BACKEND.get_info(self)
+
+
+class Image(ComputedObject):
+    _returns = {'bandNames': 'List', 'geometry': 'Geometry', 'get': 'ComputedObject', 'reduceRegion': 'Dictionary',
+                'date': 'Date'}
+
+
+class ImageCollection(ComputedObject):
+    _returns = {'size': 'Number', 'first': 'Image', 'median': 'Image', 'mean': 'Image', 'mosaic': 'Image',
+                'reduce': 'Image', 'toList': 'List', 'geometry': 'Geometry', 'get': 'ComputedObject',
+                'aggregate_histogram': 'Dictionary', 'aggregate_max': 'Number', 'aggregate_array': 'List'}
+    _element = 'Image'
+
+
+class Feature(ComputedObject):
+    _returns = {'geometry': 'Geometry', 'get': 'ComputedObject'}
+
+
+class FeatureCollection(ComputedObject):
+    _returns = {'size': 'Number', 'geometry': 'Geometry', 'toList': 'List', 'first': 'Feature',
+                'get': 'ComputedObject', 'aggregate_array': 'List', 'reduceColumns': 'Dictionary'}
+    _element = 'Feature'
+
+
+class Geometry(ComputedObject):
+    _returns = {'coordinates': 'List', 'area': 'Number'}
+
+
+class List(ComputedObject):
+    _returns = {'get': 'ComputedObject', 'size': 'Number', 'reduce': 'ComputedObject'}
+
+
+class Dictionary(ComputedObject):
+    _returns = {'keys': 'List', 'values': 'List', 'get': 'ComputedObject'}
+
+
+class Number(ComputedObject):
+    pass
+
+
+class String(ComputedObject):
+    pass
+
+
+class Date(ComputedObject):
+    _returns = {'millis': 'Number', 'get': 'Number'}
+
+
+class Array(ComputedObject):
+    pass
+
+
+class Filter(ComputedObject):
+    pass
+
+
+class Reducer(ComputedObject):
+    pass
+
+
+class Kernel(ComputedObject):
+    pass
+
+
+class Join(ComputedObject):
+    pass
+
+
+_CLASSES = {cls.__name__: cls for cls in (ComputedObject, Image, ImageCollection, Feature, FeatureCollection, Geometry,
+                                          List, Dictionary, Number, String, Date, Array, Filter, Reducer, Kernel,
+                                          Join)}
+
+
+class CustomFunction:
+    def __init__(self, body, return_type: str, arg_types: list):
+        self._returns = return_type if isinstance(return_type, str) else return_type.__name__
+        # Trace the body once with placeholder arguments, as the EE client does
+        body(*[_CLASSES[t if isinstance(t, str) else t.__name__]._call('variable', None, (), {}) for t in arg_types])
+
+    @staticmethod
+    def create(func, return_type, arg_types) -> 'CustomFunction':
+        return CustomFunction(func, return_type, arg_types)
+
+    def call(self, *args, **kwargs) -> ComputedObject:
+        return _CLASSES[self._returns]._call('CustomFunction', self, args, kwargs)
+
+
+class _Algorithms:
+    _returns = {'TemporalSegmentation.Ccdc': 'Image'}
+
+    def __init__(self, path: str = ''):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Algorithms(f'{self._path}.{name}' if self._path else name)
+
+    def __call__(self, *args, **kwargs):
+        return _CLASSES[self._returns.get(self._path, 'ComputedObject')]._call(self._path, None, args, kwargs)
+
+
+Algorithms = _Algorithms()
+
+
+class Task:
+    class State(enum.Enum):
+        UNSUBMITTED = 'UNSUBMITTED'
+        READY = 'READY'
+        RUNNING = 'RUNNING'
+        COMPLETED = 'COMPLETED'
+        FAILED = 'FAILED'
+        CANCEL_REQUESTED = 'CANCEL_REQUESTED'
+        CANCELLED = 'CANCELLED'
+
+    class Type(enum.Enum):
+        EXPORT_IMAGE = 'EXPORT_IMAGE'
+        EXPORT_TABLE = 'EXPORT_TABLE'
+
+    def __init__(self, task_id: Optional[str], task_type: 'Task.Type', state: 'Task.State', config: dict = None,
+                 name: str = None):
+        self.id = task_id
+        self.task_type = task_type
+        self.state = state
+        self.config = config or {}
+        self.name = name
+
+    def start(self):
+        BACKEND.start_task(self)
+
+    def status(self) -> dict:
+        return BACKEND.task_status(self.id)
+
+    def active(self) -> bool:
+        return self.status()['state'] in ('READY', 'RUNNING', 'CANCEL_REQUESTED')
+
+    def cancel(self):
+        BACKEND.cancel_task(self.id)
+
+
+class _ImageExport:
+    @staticmethod
+    def toAsset(image, description='myExportImageTask', assetId=None, **kwargs) -> Task:
+        config = dict(kwargs, image=image, description=description, assetId=assetId)
+        return Task(None, Task.Type.EXPORT_IMAGE, Task.State.UNSUBMITTED, config)
+
+
+class Export:
+    image = _ImageExport
+
+
+batch = types.SimpleNamespace(Task=Task, Export=Export)
+
+
+def _get_task_list() -> list[dict]:
+    return BACKEND.task_list()
+
+
+def _cancel_task(task_id: str):
+    BACKEND.cancel_task(task_id)
+
+
+def _list_assets(params) -> dict:
+    return BACKEND.list_assets(params)
+
+
+def _create_asset(value: dict, path: str = None, *args, **kwargs):
+    BACKEND.create_asset(value, path)
+
+
+def _delete_asset(asset_id: str):
+    BACKEND.delete_asset(asset_id)
+
+
+def _compute_pixels(params: dict) -> np.ndarray:
+    return BACKEND.compute_pixels(params)
+
+
+data = types.SimpleNamespace(
+    ASSET_TYPE_FOLDER='FOLDER',
+    ASSET_TYPE_IMAGE_COLL='IMAGE_COLLECTION',
+    getTaskList=_get_task_list,
+    cancelTask=_cancel_task,
+    listAssets=_list_assets,
+    createAsset=_create_asset,
+    deleteAsset=_delete_asset,
+    computePixels=_compute_pixels,
+)
+
+
+def Authenticate(*args, **kwargs):
+    pass
+
+
+def Initialize(*args, **kwargs):
+    pass
+
+
+def grid_features(num_cols: int, num_rows: int, size: float = 0.1, origin: tuple = (90.0, 30.0)) -> list[dict]:
+    """Build a regular grid of square GeoJSON polygon features, as `getInfo()` on an AOI grid returns it.
+
+    Args:
+        num_cols (int):
+        num_rows (int):
+        size (float): Side length of a cell in degrees.
+        origin (tuple): Lower left corner of the grid, (lon, lat).
+
+    Returns:
+        list[dict]:
+    """
+    features = []
+    for row in range(num_rows):
+        for col in range(num_cols):
+            x0, y0 = origin[0] + col * size, origin[1] + row * size
+            x1, y1 = x0 + size, y0 + size
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Polygon', 'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]},
+                'properties': {},
+            })
+    return features
+
+
+def install(backend: Backend) -> Backend:
+    """Make `import ee` resolve to this module, served by `backend`."""
+    global BACKEND
+    BACKEND = backend
+    sys.modules['ee'] = sys.modules[__name__]
+    return backend
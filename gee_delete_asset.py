@@ -1,10 +1,16 @@
 import ee
+from asset_catalog import AssetCatalog
 
 ee.Authenticate()
 ee.Initialize(project='ee-yangluhao990714')
 
-assets = ee.data.listAssets(params='projects/ee-yangluhao990714/assets/CCDC/tmp')
+catalog = AssetCatalog('./cache/asset_catalog.json')
+parent = 'projects/ee-yangluhao990714/assets/CCDC/tmp'
 
-for asset in assets['assets']:
-    print(asset['name'])
-    ee.data.deleteAsset(asset['name'])
\ No newline at end of file
+# A cached listing would miss new assets and list ones already deleted
+for name in sorted(catalog.names(parent, refresh=True)):
+    asset = f'{parent}/{name}'
+    print(asset)
+    ee.data.deleteAsset(asset)
+    catalog.remove(asset)
+catalog.flush()
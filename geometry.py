@@ -0,0 +1,82 @@
+"""
+geometry.py
+Client-side geometry helpers for AOI tiles. Bounding boxes are carried as plain floats, so no server round-trip is
+needed to know the extent of a tile.
+"""
+import math
+from dataclasses import dataclass
+import ee
+
+EARTH_RADIUS = 6371008.8  # meters, mean radius
+SCALE_10M = 10 / 111319.49079327357  # 10 m in degrees of EPSG:4326, as EE converts export scales at the equator
+
+
+def _iter_positions(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        yield coords
+        return
+    for item in coords:
+        yield from _iter_positions(item)
+
+
+@dataclass(frozen=True)
+class BBox:
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+
+    @classmethod
+    def from_geojson(cls, geojson: dict) -> 'BBox':
+        """Compute the bounding box of a GeoJSON geometry.
+
+        Only the exterior rings are used, holes never extend a bounding box.
+
+        Args:
+            geojson (dict): GeoJSON geometry, `Polygon` or `MultiPolygon`.
+
+        Returns:
+            BBox:
+
+        Examples:
+            >>> BBox.from_geojson({'type': 'Polygon', 'coordinates': [[[0, 0], [2, 0], [2, 1], [0, 1], [0, 0]]]})
+            BBox(xmin=0, ymin=0, xmax=2, ymax=1)
+            >>> BBox.from_geojson({'type': 'MultiPolygon', 'coordinates': [
+            ...     [[[0, 0], [1, 0], [1, 1], [0, 0]]], [[[3, -1], [4, -1], [4, 2], [3, -1]]]]})
+            BBox(xmin=0, ymin=-1, xmax=4, ymax=2)
+        """
+        match geojson['type']:
+            case 'Polygon':
+                rings = [geojson['coordinates'][0]]
+            case 'MultiPolygon':
+                rings = [polygon[0] for polygon in geojson['coordinates']]
+            case _:
+                raise ValueError(f'The geometry type [{geojson["type"]}] is not supported.')
+        xs, ys = [], []
+        for position in _iter_positions(rings):
+            xs.append(position[0])
+            ys.append(position[1])
+        return cls(min(xs), min(ys), max(xs), max(ys))
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'BBox':
+        return cls(d['xmin'], d['ymin'], d['xmax'], d['ymax'])
+
+    def area(self) -> float:
+        """Area of the bounding box on a spherical earth in square meters.
+
+        Examples:
+            >>> round(BBox(0, 0, 1, 1).area() / 1e6)
+            12364
+        """
+        d_lon = math.radians(self.xmax - self.xmin)
+        return EARTH_RADIUS ** 2 * d_lon * (math.sin(math.radians(self.ymax)) - math.sin(math.radians(self.ymin)))
+
+    def to_ee(self) -> ee.Geometry:
+        return ee.Geometry.Rectangle([self.xmin, self.ymin, self.xmax, self.ymax])
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
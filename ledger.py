@@ -0,0 +1,158 @@
+"""
+ledger.py
+Crash-safe on-disk record of every exported tile, so an interrupted run can be resumed.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from geometry import BBox
+
+QUEUED = 'QUEUED'
+READY = 'READY'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+SPLIT = 'SPLIT'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tiles (
+    file_name TEXT PRIMARY KEY,
+    parent TEXT,
+    xmin REAL NOT NULL,
+    ymin REAL NOT NULL,
+    xmax REAL NOT NULL,
+    ymax REAL NOT NULL,
+    attempt INTEGER NOT NULL,
+    task_id TEXT,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+'''
+
+_INPUTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tile_inputs (
+    file_name TEXT PRIMARY KEY,
+    scene_count INTEGER NOT NULL,
+    latest_time_start INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+)
+'''
+
+
+class Ledger:
+    """SQLite (WAL mode) table of tiles, keyed by the exported file name.
+
+    Every method commits its own transaction, the ledger can be shared between threads. The state of every tile and
+    the pieces of split tiles are also indexed in memory, so looking them up needs no query.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+            self._conn.execute(_INPUTS_SCHEMA)
+        self._states: dict[str, str] = {}
+        self._children: dict[str, set[str]] = {}
+        for row in self._execute('SELECT file_name, parent, state FROM tiles'):
+            self._index(row['file_name'], row['state'], row['parent'])
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[dict]:
+        with self._lock, self._conn:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def _index(self, file_name: str, state: str, parent: str = None):
+        with self._lock:
+            self._states[file_name] = state
+            if parent is not None:
+                self._children.setdefault(parent, set()).add(file_name)
+
+    def reset(self):
+        """Forget every tile. The recorded tile inputs are kept for the next incremental run."""
+        self._execute('DELETE FROM tiles')
+        with self._lock:
+            self._states.clear()
+            self._children.clear()
+
+    def queued(self, file_name: str, bbox: BBox, attempt: int, parent: str = None):
+        """Record a tile waiting in the export queue. A tile which is queued again keeps its parent."""
+        self._execute(
+            '''INSERT INTO tiles (file_name, parent, xmin, ymin, xmax, ymax, attempt, task_id, state, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)
+               ON CONFLICT(file_name) DO UPDATE SET
+                   xmin = excluded.xmin, ymin = excluded.ymin, xmax = excluded.xmax, ymax = excluded.ymax,
+                   attempt = excluded.attempt, task_id = NULL, state = excluded.state,
+                   updated_at = excluded.updated_at''',
+            (file_name, parent, bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax, attempt, QUEUED, time.time()),
+        )
+        self._index(file_name, QUEUED, parent)
+
+    def started(self, file_name: str, task_id: str):
+        self._execute('UPDATE tiles SET task_id = ?, state = ?, updated_at = ? WHERE file_name = ?',
+                      (task_id, READY, time.time(), file_name))
+        self._index(file_name, READY)
+
+    def set_state(self, file_name: str, state: str):
+        self._execute('UPDATE tiles SET state = ?, updated_at = ? WHERE file_name = ?',
+                      (state, time.time(), file_name))
+        self._index(file_name, state)
+
+    def rows(self, *states: str) -> list[dict]:
+        """Get all tiles in one of the given states, or all tiles if no state is given."""
+        if not states:
+            return self._execute('SELECT * FROM tiles ORDER BY rowid')
+        placeholders = ', '.join('?' * len(states))
+        return self._execute(f'SELECT * FROM tiles WHERE state IN ({placeholders}) ORDER BY rowid', states)
+
+    def state(self, file_name: str) -> Optional[str]:
+        with self._lock:
+            return self._states.get(file_name)
+
+    def incomplete(self, file_name: str) -> list[str]:
+        """Get what is left to export of a tile, itself, or the pieces of a split tile which did not complete.
+
+        Args:
+            file_name (str): Tile, or piece of a tile.
+
+        Returns:
+            list[str]: Tiles not completed, in the order of their names, nothing if the tile is completely exported.
+        """
+        with self._lock:
+            state = self._states.get(file_name)
+            children = sorted(self._children.get(file_name, ()))
+        if state == COMPLETED:
+            return []
+        if state == SPLIT:
+            return [name for child in children for name in self.incomplete(child)]
+        return [file_name]
+
+    def inputs(self) -> dict[str, tuple[int, int]]:
+        """Get the (scene count, latest system:time_start) of the CCDC input of every tile exported so far."""
+        return {row['file_name']: (row['scene_count'], row['latest_time_start'])
+                for row in self._execute('SELECT * FROM tile_inputs')}
+
+    def record_inputs(self, inputs: dict[str, tuple[int, int]]):
+        """Record the (scene count, latest system:time_start) of the CCDC input of tiles, in one transaction."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                '''INSERT INTO tile_inputs (file_name, scene_count, latest_time_start, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(file_name) DO UPDATE SET
+                       scene_count = excluded.scene_count, latest_time_start = excluded.latest_time_start,
+                       updated_at = excluded.updated_at''',
+                [(file_name, scene_count, latest, now) for file_name, (scene_count, latest) in inputs.items()],
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
@@ -1,19 +1,32 @@
 import ee
+import os
+import shutil
 import threading
 import time
+import argparse
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-import os
-import inspect
-import datetime
-from ccdc_result_handler import ccdc_result_handler
+import utils
+import aoi_grid
+from utils import log, log_err
+from ccdc_result_handler import ASSET_CATALOG_PATH, ccdc_result_handler
+from asset_catalog import AssetCatalog
+from geometry import BBox
+import ledger
+from ledger import Ledger
+import pixel_sink
+import quadkey
+from scheduler import ConcurrencyController
+from priority_queue import PriorityQueue, retries_then_largest
 
 ee.Authenticate()
 ee.Initialize(project='project-id')
 
 EE_TASK_MONITORING_QUEUE: dict[dict: dict] = {}
 EE_TASK_MONITORING_QUEUE_LOCK = threading.Lock()
-EE_TASK_QUEUE: list[dict] = []
-EE_TASK_QUEUE_LOCK = threading.Lock()
+SUBMISSION_DONE = threading.Event()  # Set once every tile is queued, ee_task_monitor stops when nothing is left then
 
 band_groups = {
     'tBreak': False,
@@ -32,104 +45,91 @@ def expand_band(name: str, magnitude: bool = False, n: int = 10):
     else:
         return [f'{name}_{i}' for i in range(n)]
 
-BAND_LIST = ee.List([
-    ee.Dictionary({name if not mag else f'{name}_magnitude': expand_band(name, mag)})
+# CCDC output band to the names of its flattened bands
+BAND_LIST = {
+    name if not mag else f'{name}_magnitude': expand_band(name, mag)
     for name, mag in band_groups.items()
-])
+}
 
 START_DATE = ee.Date('2015-06-27')
 END_DATE = ee.Date('2025-08-21')
 AOI_GRID = ee.FeatureCollection('projects/project-id/assets/AOIs/aoi')
+# Local GeoJSON or GeoPackage copy of AOI_GRID, in the same order, to read the tiles from instead, None to page AOI_GRID
+AOI_GRID_FILE = None
+AOI_GRID_PAGE_SIZE = 500  # Tiles fetched per request while paging AOI_GRID
 TP_FOREST_MASK: ee.Image = ee.Image('').select(['b1']).neq(0)
 COLLECTION_TITLE = 'COPERNICUS/S2_HARMONIZED'
 IMAGE_COLLECTION = ee.ImageCollection(COLLECTION_TITLE)
-MAX_PARALLEL_TASKS = 10
+PARALLEL_TASKS_INITIAL = 10  # Tasks in flight are adapted by CONCURRENCY between the floor and the ceiling
+PARALLEL_TASKS_FLOOR = 2
+PARALLEL_TASKS_CEILING = 100
+TARGET_READY_LATENCY = 600  # seconds, tasks waiting longer in READY mean EE has no slots left for more
+POLL_INTERVAL = 10  # seconds, used right after a task changed its state
+MAX_POLL_INTERVAL = 120  # seconds, the poll interval doubles up to this while nothing changes
 CANCLE_TASK_TO_SPLIT = True
 OUTPUT_COLLECTION = 'CCDC/ccdc_raw/'
-SPLIT_BY = 2
+SPLIT_MAX_FRACTION = 0.25  # Largest share of a tile's pixels in one piece when it is split after a failure
+CLOUD_MASK_STRATEGY = 'link'  # How images are matched with Cloud Score+, see utils.remove_clouds
+CLOUD_SCORE_THRESHOLD = 0.5
+CLOUD_SCORE_BAND = 'cs'
+CCDC_BANDS = ['Blue', 'Green', 'Red', 'NIR', 'SWIR1', 'SWIR2']
+# Estimated cost (scenes x 10 m pixels x bands) a tile may have before it is split up front, None to disable.
+# Tiles above roughly this size used to fail with "User memory limit exceeded.", tune it with the ledger history.
+PRESPLIT_COST_BUDGET = 5e10
 ASSETS_PATH = ''
+LEDGER_PATH = './ledger/ledger.sqlite3'
+TILE_COSTS_PATH = './cache/tile_costs.json'  # See tile_costs
+TILE_COST_COLUMNS = ['scene_count', 'cloud_free', 'area', 'latest_time_start']
+EE_TASK_QUEUE_SIZE = 250  # Tiles waiting for a free slot, building more graphs blocks until the queue drains
+EE_TASK_PRIORITY = retries_then_largest  # Which waiting tile starts first, see priority_queue.PriorityQueue
+GRAPH_WORKERS = 8  # Threads building tile graphs in ccdc_main
+EXPORT_SINK = 'asset'  # 'asset' exports tiles to OUTPUT_COLLECTION, 'local' downloads them into LOCAL_STORE_PATH
+LOCAL_STORE_PATH = './pixels'
 
 
 OUTPUT_COLLECTION = OUTPUT_COLLECTION if OUTPUT_COLLECTION.endswith('/') else OUTPUT_COLLECTION + '/'
 ASSETS_PATH = ASSETS_PATH if ASSETS_PATH.endswith('/') else ASSETS_PATH + '/'
+LEDGER = Ledger(LEDGER_PATH)
+TILE_COSTS: dict[str, dict] = {}
+EE_TASK_QUEUE = PriorityQueue(EE_TASK_QUEUE_SIZE, EE_TASK_PRIORITY)
+CONCURRENCY = ConcurrencyController(PARALLEL_TASKS_INITIAL, PARALLEL_TASKS_FLOOR, PARALLEL_TASKS_CEILING,
+                                    target_ready_latency=TARGET_READY_LATENCY)
 
 
-def _log(self, msg):
-    if not os.path.exists('./log'):
-        os.makedirs('./log')
-    with open('./log/log.log', 'a') as f:
-        function_name = inspect.currentframe().f_back.f_code.co_name
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        f.write(f'[{timestamp}] [{function_name}]: {msg}\n')
-
-
-def _log_err(self, msg):
-    if not os.path.exists('./log'):
-        os.makedirs('./log')
-    with open('./log/err.log', 'a') as f:
-        function_name = inspect.currentframe().f_back.f_code.co_name
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        f.write(f'[{timestamp}] [{function_name}]: {msg}\n')
-
-
-def log(msg):
-    thread = threading.Thread(target=_log, args=(msg,)).start()
-
-
-def log_err(msg):
-    thread = threading.Thread(target=_log_err, args=(msg,)).start()
-
-
-def append_ee_task_queue(task: ee.batch.Task, aoi: ee.Geometry, file_name: str, attempt: int):
-    aoi_coords = aoi.coordinates()
-    coords = ee.List(aoi_coords.get(0))
-    xmin = coords.map(lambda p: ee.Number(ee.List(p).get(0))).reduce(ee.Reducer.min())
-    ymin = coords.map(lambda p: ee.Number(ee.List(p).get(1))).reduce(ee.Reducer.min())
-    xmax = coords.map(lambda p: ee.Number(ee.List(p).get(0))).reduce(ee.Reducer.max())
-    ymax = coords.map(lambda p: ee.Number(ee.List(p).get(1))).reduce(ee.Reducer.max())
-
-    xmin = ee.Number(xmin).getInfo()
-    ymin = ee.Number(ymin).getInfo()
-    xmax = ee.Number(xmax).getInfo()
-    ymax = ee.Number(ymax).getInfo()
-
-    while True:
-        with EE_TASK_QUEUE_LOCK:
-            if len(EE_TASK_QUEUE) < 250:
-                break
-        time.sleep(30)
-
-    with EE_TASK_QUEUE_LOCK:
-        EE_TASK_QUEUE.append({'task': task, 'aoi_coords': {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax},
-                              'file_name': file_name, 'attempt': attempt, })
+def append_ee_task_queue(task: ee.batch.Task, bbox: BBox, file_name: str, attempt: int):
+    # Retries come from the monitor thread, the only consumer of the queue, so they must never wait for it
+    EE_TASK_QUEUE.put({'task': task, 'bbox': bbox, 'file_name': file_name, 'attempt': attempt,
+                       'cost': tile_cost(file_name, bbox)}, force=attempt > 1)
 
 
 def get_ee_task_queue() -> Optional[dict]:
-    if len(EE_TASK_QUEUE) == 0:
+    try:
+        return EE_TASK_QUEUE.get(block=False)
+    except queue.Empty:
         return None
-    with EE_TASK_QUEUE_LOCK:
-        return EE_TASK_QUEUE.pop(0)
 
 
-def append_ee_task_monitoring_queue(task: ee.batch.Task, aoi_coords: ee.List, file_name: str, attempt: int):
+def append_ee_task_monitoring_queue(task_id: str, bbox: BBox, file_name: str, attempt: int,
+                                    state: ee.batch.Task.State = ee.batch.Task.State.READY):
     with EE_TASK_MONITORING_QUEUE_LOCK:
-        EE_TASK_MONITORING_QUEUE[task.id] = {  # To cut current aoi into smaller pieces
-            'aoi_coords': aoi_coords,
-            # To get the task info, the three fields are necessary
-            'id': task.id,
-            'state': ee.batch.Task.State(task.status()['state']),
-            'type': ee.batch.Task.Type(task.status()['task_type']),
+        EE_TASK_MONITORING_QUEUE[task_id] = {  # To cut current aoi into smaller pieces
+            'bbox': bbox,
+            'id': task_id,
+            # Last known state, a freshly started task is always READY
+            'state': state,
             'file_name': file_name,
-            'attempt': attempt, }
+            'attempt': attempt,
+            'started_at': time.time(), }
 
 
 def ccdc_image_collection_preprocess(aoi: ee.Geometry) -> ee.ImageCollection:
     img_col = IMAGE_COLLECTION.filterBounds(aoi).filterDate(START_DATE, END_DATE)
-    img_col = img_col.remove_clouds(COLLECTION_TITLE)
+    img_col = img_col.remove_clouds(COLLECTION_TITLE, CLOUD_MASK_STRATEGY, CLOUD_SCORE_THRESHOLD, CLOUD_SCORE_BAND,
+                                    aoi, START_DATE, END_DATE)
     img_col = img_col.band_rename(COLLECTION_TITLE)
     img_col = img_col.map(lambda img: img.updateMask(
         img.ndsi().select('NDSI').lt(0).And(img.ndwi().select('NDWI').lt(0))))
-    ret = img_col.select(['Blue', 'Green', 'Red', 'NIR', 'SWIR1', 'SWIR2'])
+    ret = img_col.select(CCDC_BANDS)
     return ret
 
 
@@ -145,172 +145,513 @@ def ccdc(ccdc_input: ee.ImageCollection, aoi: ee.Geometry) -> ee.Image:
 
 
 def ccdc_result_flaten(ccdc_result: ee.Image) -> ee.Image:
-    ccdc_result_flat_list = BAND_LIST.map(
-        lambda band: ccdc_result.select([ee.Dictionary(band).keys().get(0)]).arrayPad([10], 0) \
-            .arrayFlatten([ee.Dictionary(band).values().get(0)])
-    )
-    ccdc_result_flat = ee.Image(ccdc_result_flat_list.get(0)) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(1))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(2))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(3))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(4))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(5))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(6))) \
-        .addBands(ee.Image(ccdc_result_flat_list.get(7)))
+    ccdc_result_flat = ee.Image.cat([
+        ccdc_result.select([band]).arrayPad([10], 0).arrayFlatten([flat_bands])
+        for band, flat_bands in BAND_LIST.items()
+    ])
     return ccdc_result_flat
 
 
-def ccdc_result_export(ccdc_result_flat: ee.Image, aoi: ee.Geometry, file_name: str, attempt: int = 1):
+_CCDC_GRAPH_TEMPLATE: Optional[ee.CustomFunction] = None
+_CCDC_GRAPH_TEMPLATE_LOCK = threading.Lock()
+
+
+def ccdc_graph(aoi: ee.Geometry) -> ee.Image:
+    """Get the flattened CCDC result of an AOI.
+
+    The graph (collection filtering, cloud masking, renames, NDSI/NDWI mask, CCDC and flattening) only differs in the
+    AOI between tiles, so it is traced once into an `ee.CustomFunction` of the AOI and every tile just invokes it.
+
+    Args:
+        aoi (ee.Geometry):
+
+    Returns:
+        ee.Image:
+    """
+    global _CCDC_GRAPH_TEMPLATE
+    with _CCDC_GRAPH_TEMPLATE_LOCK:
+        if _CCDC_GRAPH_TEMPLATE is None:
+            _CCDC_GRAPH_TEMPLATE = ee.CustomFunction.create(
+                lambda aoi_var: ccdc_result_flaten(ccdc(ccdc_image_collection_preprocess(aoi_var), aoi_var)),
+                'Image', ['Geometry'],
+            )
+    return ee.Image(_CCDC_GRAPH_TEMPLATE.call(aoi))
+
+
+def ccdc_result_export(ccdc_result_flat: ee.Image, aoi: ee.Geometry, bbox: BBox, file_name: str, attempt: int = 1,
+                       parent: str = None):
+    if EXPORT_SINK == 'local':
+        LEDGER.queued(file_name, bbox, attempt, parent)
+        ok = pixel_sink.download_image(ccdc_result_flat.clip(aoi), f'{LOCAL_STORE_PATH}/{file_name}',
+                                       quadkey.snap(bbox), [band for bands in BAND_LIST.values() for band in bands])
+        LEDGER.set_state(file_name, ledger.COMPLETED if ok else ledger.FAILED)
+        return
     task = ee.batch.Export.image.toAsset(
         image=ccdc_result_flat.clip(aoi),
         description='export_' + file_name,
         assetId=f'{ASSETS_PATH}{OUTPUT_COLLECTION}{file_name}',
-        scale=10,
         region=aoi,
         maxPixels=1e13,
         crs='EPSG:4326',
+        crsTransform=quadkey.CRS_TRANSFORM,
     )
-    append_ee_task_queue(task, aoi, file_name, attempt)
+    LEDGER.queued(file_name, bbox, attempt, parent)
+    append_ee_task_queue(task, bbox, file_name, attempt)
+
+
+def tile_name(file_name: str, key: str) -> str:
+    """Get the name of the piece of a grid tile at a quadkey, see `quadkey.split`."""
+    return f'{file_name}_{key}' if key else file_name
+
+
+def parse_tile_name(file_name: str) -> tuple[str, str]:
+    """Get the grid tile and the quadkey of a piece, `ccdc_result_12_0312` is ('ccdc_result_12', '0312')."""
+    parts = file_name.split('_')
+    return '_'.join(parts[:3]), '_'.join(parts[3:4])
+
+
+def ccdc_bbox_export(bbox: BBox, file_name: str, attempt: int = 1, parent: str = None):
+    if LEDGER.state(file_name) == ledger.COMPLETED:
+        # Quadkeys name a piece the same way whichever split produced it
+        log(f'{file_name} is already exported', tile=file_name)
+        return
+    aoi = bbox.to_ee()
+    ccdc_result_export(ccdc_graph(aoi), aoi, bbox, file_name, attempt, parent)
+
+
+def estimate_ccdc_cost(scene_count: int, bbox: BBox, band_count: int = len(CCDC_BANDS)) -> float:
+    """Estimate the cost of running CCDC over a tile, as scenes x 10 m pixels x bands.
+
+    Args:
+        scene_count (int): Number of scenes after `ccdc_image_collection_preprocess`.
+        bbox (BBox): Extent of the tile.
+        band_count (int): Number of CCDC input bands.
+
+    Returns:
+        float:
+    """
+    return scene_count * bbox.area() / 10 ** 2 * band_count
+
+
+def plan_tile(bbox: BBox, scene_count: int) -> list[tuple[str, BBox]]:
+    """Split a tile up front along the quadtree grid so that each piece stays within PRESPLIT_COST_BUDGET.
+
+    The scenes of a tile cover all its pieces, so the scene count is kept and only the area shrinks.
+
+    Args:
+        bbox (BBox): Extent of the tile.
+        scene_count (int): Number of scenes after `ccdc_image_collection_preprocess`.
+
+    Returns:
+        list[tuple[str, BBox]]: (quadkey, extent) of the pieces to export, just `[('', bbox)]` if the tile fits the
+            budget.
+    """
+    if PRESPLIT_COST_BUDGET is None or estimate_ccdc_cost(scene_count, bbox) <= PRESPLIT_COST_BUDGET:
+        return [('', bbox)]
+    for levels in range(1, quadkey.MAX_LEVEL + 1):
+        pieces = quadkey.split(bbox, levels=levels)
+        if max(estimate_ccdc_cost(scene_count, piece) for _, piece in pieces) <= PRESPLIT_COST_BUDGET:
+            break
+    return pieces
 
 
 def start_one_task():
     task_dict = get_ee_task_queue()
     if task_dict is not None:
         task_dict['task'].start()
-        append_ee_task_monitoring_queue(task_dict['task'], task_dict['aoi_coords'], task_dict['file_name'],
+        LEDGER.started(task_dict['file_name'], task_dict['task'].id)
+        append_ee_task_monitoring_queue(task_dict['task'].id, task_dict['bbox'], task_dict['file_name'],
                                         task_dict['attempt'])
-        print('Task', task_dict['task'].id, 'started')
-
-
-def ccdc_main():
-    index = 0
-    for aoi_grid_feature in AOI_GRID.getInfo()['features']:
-        aoi = ee.Feature(aoi_grid_feature['geometry']).geometry()
-        ccdc_input = ccdc_image_collection_preprocess(aoi)
-        ccdc_result = ccdc(ccdc_input, aoi)
-        ccdc_result_flat = ccdc_result_flaten(ccdc_result)
-        file_name = f'ccdc_result_{index}'
-        ccdc_result_export(ccdc_result_flat, aoi, file_name)
-        index += 1
+        log(f'Task {task_dict["task"].id} started', tile=task_dict['file_name'], task_id=task_dict['task'].id,
+            state='READY', attempt=task_dict['attempt'])
+
+
+def ccdc_tile_export(aoi_grid_feature: dict, file_name: str):
+    aoi = ee.Feature(aoi_grid_feature['geometry']).geometry()
+    bbox = BBox.from_geojson(aoi_grid_feature['geometry'])
+    if PRESPLIT_COST_BUDGET is not None:
+        costs = TILE_COSTS.get(file_name)
+        scene_count = costs['scene_count'] if costs else ccdc_image_collection_preprocess(aoi).size().getInfo()
+        plan = plan_tile(bbox, scene_count)
+        if len(plan) > 1:
+            log(f'{file_name} is split into {len(plan)} tiles before submission', tile=file_name)
+            LEDGER.queued(file_name, bbox, 1)
+            for key, bbox_cut in plan:
+                if LEDGER.state(tile_name(file_name, key)) is not None:
+                    # Queued by a run which crashed before the tile was split, ee_task_resume took care of it
+                    continue
+                ccdc_bbox_export(bbox_cut, tile_name(file_name, key), 1, file_name)
+            LEDGER.set_state(file_name, ledger.SPLIT)
+            return
+    ccdc_result_export(ccdc_graph(aoi), aoi, bbox, file_name)
+
+
+def ccdc_main(skip: set[str] = None):
+    """Export CCDC results for every tile of AOI_GRID.
+
+    Tiles are streamed from AOI_GRID_FILE, or from AOI_GRID one page at a time, and their graphs are built and queued
+    by GRAPH_WORKERS threads. At most two tiles per worker wait for a thread, and the workers block while the export
+    queue is full. Tiles are planned with `tile_costs`, or with one scene count request each if the table cannot be
+    fetched.
+
+    Args:
+        skip (set[str]): File names of the tiles which are not exported again, see `ee_task_resume` and
+            `ee_task_incremental`.
+    """
+    skip = skip or set()
+    pending = threading.BoundedSemaphore(GRAPH_WORKERS * 2)
+    try:
+        tile_costs()
+    except Exception as e:
+        log_err(f'Failed to get the tile costs: {e}')
+
+    def run_one(aoi_grid_feature: dict, file_name: str):
+        try:
+            ccdc_tile_export(aoi_grid_feature, file_name)
+        except Exception as e:
+            log_err(f'Failed to submit {file_name}: {e}', tile=file_name)
+        finally:
+            pending.release()
+
+    with ThreadPoolExecutor(max_workers=GRAPH_WORKERS) as executor:
+        for index, aoi_grid_feature in enumerate(aoi_grid.iter_features(AOI_GRID_FILE or AOI_GRID, AOI_GRID_PAGE_SIZE)):
+            file_name = f'ccdc_result_{index}'
+            if file_name in skip:
+                continue
+            pending.acquire()
+            executor.submit(run_one, aoi_grid_feature, file_name)
+
+
+def ee_task_resume() -> set[str]:
+    """Resume the tiles recorded in the ledger by a previous run.
+
+    Running tasks are re-attached to the monitor, tasks which were started right before the crash are found by their
+    description. Queued split/retry tiles are exported again from their bounding box, completed, failed and split
+    tiles are left alone. Grid tiles missing from the ledger but with an output, those an interrupted incremental run
+    left unchanged, are skipped too.
+
+    Returns:
+        set[str]: File names of the grid tiles which `ccdc_main` must skip.
+    """
+    rows = LEDGER.rows()
+    active_tasks = {status['description']: status for status in ee.data.getTaskList()
+                    if status['state'] in ('READY', 'RUNNING')}
+    skip = set()
+    for row in rows:
+        bbox = BBox.from_dict(row)
+        if row['state'] == ledger.QUEUED and f'export_{row["file_name"]}' in active_tasks:
+            task_status = active_tasks[f'export_{row["file_name"]}']
+            LEDGER.started(row['file_name'], task_status['id'])
+            row['state'], row['task_id'] = task_status['state'], task_status['id']
+        if row['state'] in (ledger.READY, ledger.RUNNING):
+            append_ee_task_monitoring_queue(row['task_id'], bbox, row['file_name'], row['attempt'],
+                                            ee.batch.Task.State(row['state']))
+            log(f'Task {row["task_id"]} of {row["file_name"]} re-attached', tile=row['file_name'],
+                task_id=row['task_id'], state=row['state'], attempt=row['attempt'])
+        elif row['state'] == ledger.QUEUED:
+            if row['parent'] is None:
+                # Grid tiles are rebuilt from their original geometry by ccdc_main
+                continue
+            ccdc_bbox_export(bbox, row['file_name'], row['attempt'], row['parent'])
+        skip.add(row['file_name'])
+    local = EXPORT_SINK == 'local'
+    outputs = _tile_outputs(LOCAL_STORE_PATH if local else f'{ASSETS_PATH}{OUTPUT_COLLECTION}', local)
+    # ee_task_incremental resets the ledger and records only the tiles it exports again
+    skip.update(file_name for file_name in outputs if LEDGER.state(file_name) is None)
+    return skip
+
+
+def tile_costs(refresh: bool = False) -> dict[str, dict]:
+    """Get what the cost of every tile of AOI_GRID depends on, fetched for all tiles with a single request.
+
+    Per tile, by file name:
+        scene_count: Number of scenes after `ccdc_image_collection_preprocess`.
+        cloud_free: Mean cloud free fraction of those scenes, from their CLOUDY_PIXEL_PERCENTAGE.
+        area: Area of the tile in square meters.
+        latest_time_start: system:time_start of the latest scene, 0 without scenes.
+
+    The table is kept in TILE_COSTS and cached in TILE_COSTS_PATH, later calls and runs read it from there. Refresh it
+    whenever AOI_GRID, the dates or the collection change.
+
+    Args:
+        refresh (bool): Fetch the table again even if it is cached.
+
+    Returns:
+        dict[str, dict]:
+    """
+    if TILE_COSTS and not refresh:
+        return TILE_COSTS
+    if os.path.exists(TILE_COSTS_PATH) and not refresh:
+        with open(TILE_COSTS_PATH) as f:
+            TILE_COSTS.update(json.load(f))
+        return TILE_COSTS
+
+    def costs(feature):
+        feature = ee.Feature(feature)
+        img_col = ccdc_image_collection_preprocess(feature.geometry())
+        scene_count = img_col.size()
+        # A null property would drop the tile from reduceColumns and shift the ones after it
+        return feature.set({
+            'scene_count': scene_count,
+            'cloud_free': ee.Algorithms.If(
+                scene_count.gt(0), ee.Number(1).subtract(img_col.aggregate_mean('CLOUDY_PIXEL_PERCENTAGE').divide(100)),
+                0),
+            'area': feature.geometry().area(1),
+            'latest_time_start': ee.Algorithms.If(scene_count.gt(0), img_col.aggregate_max('system:time_start'), 0),
+        })
+
+    rows = AOI_GRID.map(costs).reduceColumns(ee.Reducer.toList(len(TILE_COST_COLUMNS)), TILE_COST_COLUMNS)
+    table = {f'ccdc_result_{index}': dict(zip(TILE_COST_COLUMNS, row))
+             for index, row in enumerate(rows.get('list').getInfo())}
+    for row in table.values():
+        row['scene_count'], row['latest_time_start'] = int(row['scene_count']), int(row['latest_time_start'])
+    directory = os.path.dirname(TILE_COSTS_PATH)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(f'{TILE_COSTS_PATH}.tmp', 'w') as f:
+        json.dump(table, f)
+    os.replace(f'{TILE_COSTS_PATH}.tmp', TILE_COSTS_PATH)
+    TILE_COSTS.clear()
+    TILE_COSTS.update(table)
+    return TILE_COSTS
+
+
+def tile_inputs() -> dict[str, tuple[int, int]]:
+    """Get the scene count and the latest system:time_start of every tile of AOI_GRID, refreshing `tile_costs`.
+
+    Returns:
+        dict[str, tuple[int, int]]: (scene count, latest system:time_start or 0 without scenes) by file name.
+    """
+    return {file_name: (costs['scene_count'], costs['latest_time_start'])
+            for file_name, costs in tile_costs(refresh=True).items()}
+
+
+def tile_cost(file_name: str, bbox: BBox) -> float:
+    """Estimate the CCDC cost of a tile or a piece of it with the scene count of its grid tile from `tile_costs`.
+
+    Tiles missing from the table count a single scene, which orders them by area.
+    """
+    costs = TILE_COSTS.get(parse_tile_name(file_name)[0])
+    return estimate_ccdc_cost(costs['scene_count'] if costs else 1, bbox)
+
+
+def _tile_outputs(parent: str, local: bool = False) -> dict[str, list[str]]:
+    """Get the assets under an EE folder, or the finished stores under a local directory, by their grid tile.
+
+    A tile owns the outputs named after it and after its split pieces or years, `ccdc_result_12_0312` belongs to
+    `ccdc_result_12`. Stores left partial by a failed download do not count.
+    """
+    if local:
+        names = [os.path.join(parent, name) for name in sorted(pixel_sink.finished_stores(parent))]
+    else:
+        names = utils.iter_asset_names(parent)
+    outputs = {}
+    for name in names:
+        outputs.setdefault(parse_tile_name(os.path.basename(name))[0], []).append(name)
+    return outputs
+
+
+def ee_task_incremental(derived_paths: list[str] = ()) -> set[str]:
+    """Find the tiles whose CCDC input changed since the last run, e.g. after END_DATE was extended.
+
+    The inputs of all tiles are fetched by `tile_inputs` and compared with those recorded in the ledger. A tile is
+    exported again if its scene count or latest scene changed, or if it has no output left. The outputs of those tiles,
+    and the assets made from them in derived_paths, are deleted first so that they can be made again.
+
+    Args:
+        derived_paths (list[str]): EE folders of assets made from the tiles, such as the handler's tmp path.
+
+    Returns:
+        set[str]: File names of the grid tiles which `ccdc_main` must skip.
+    """
+    current = tile_inputs()
+    previous = LEDGER.inputs()
+    local = EXPORT_SINK == 'local'
+    outputs = _tile_outputs(LOCAL_STORE_PATH if local else f'{ASSETS_PATH}{OUTPUT_COLLECTION}', local)
+    changed = {file_name: row for file_name, row in current.items()
+               if previous.get(file_name) != row or file_name not in outputs}
+    derived = [_tile_outputs(path) for path in derived_paths]
+    # Deletions go through the handler's asset catalog, which would otherwise still list the assets
+    catalog = AssetCatalog(ASSET_CATALOG_PATH)
+    for file_name in changed:
+        for name in outputs.get(file_name, []):
+            if local:
+                shutil.rmtree(name)
+            else:
+                ee.data.deleteAsset(name)
+                catalog.remove(name)
+        for name in (name for assets in derived for name in assets.get(file_name, [])):
+            ee.data.deleteAsset(name)
+            catalog.remove(name)
+    catalog.flush()
+    # Recorded before the exports finish, a tile whose export fails has no output and is exported again next time
+    LEDGER.record_inputs(changed)
+    log(f'{len(changed)} of {len(current)} tiles changed since the last run')
+    return set(current) - set(changed)
 
 
 def ee_task_aoi_split_retry(task_id: str):
     with EE_TASK_MONITORING_QUEUE_LOCK:
-        aoi_coords = EE_TASK_MONITORING_QUEUE[task_id]['aoi_coords']
+        bbox = EE_TASK_MONITORING_QUEUE[task_id]['bbox']
         file_name = EE_TASK_MONITORING_QUEUE[task_id]['file_name']
         attempt = EE_TASK_MONITORING_QUEUE[task_id]['attempt'] + 1
         del EE_TASK_MONITORING_QUEUE[task_id]
 
     if attempt > 100:
-        print(f'Task[{task_id}] failed {attempt} times, aborting')
+        log_err(f'Task[{task_id}] failed {attempt} times, aborting', tile=file_name, task_id=task_id,
+                attempt=attempt)
+        LEDGER.set_state(file_name, ledger.FAILED)
         return
 
-    xmin = aoi_coords['xmin']
-    ymin = aoi_coords['ymin']
-    xmax = aoi_coords['xmax']
-    ymax = aoi_coords['ymax']
-
-    num_rows = SPLIT_BY
-    num_cols = SPLIT_BY
-
-    dx = (xmax - xmin) / num_cols
-    dy = (ymax - ymin) / num_rows
-
-    index = 0
-    for row in range(num_rows):
-        for col in range(num_cols):
-            x0 = xmin + (dx * col)
-            y0 = ymin + (dy * row)
-            x1 = x0 + dx
-            y1 = y0 + dy
-            aoi = ee.Geometry.Rectangle([x0, y0, x1, y1])
-            ccdc_input = ccdc_image_collection_preprocess(aoi)
-            ccdc_result = ccdc(ccdc_input, aoi)
-            ccdc_result_flat = ccdc_result_flaten(ccdc_result)
-            file_name_cut = f'{file_name}_{index}'
-            ccdc_result_export(ccdc_result_flat, aoi, file_name_cut, attempt)
-            index += 1
+    grid_tile, key = parse_tile_name(file_name)
+    pieces = quadkey.split_evenly(bbox, key, SPLIT_MAX_FRACTION)
+    if pieces[0][0] == key:
+        log_err(f'Task[{task_id}] failed on a single pixel, aborting', tile=file_name, task_id=task_id,
+                attempt=attempt)
+        LEDGER.set_state(file_name, ledger.FAILED)
+        return
+    for key_cut, bbox_cut in pieces:
+        ccdc_bbox_export(bbox_cut, tile_name(grid_tile, key_cut), attempt, file_name)
+    LEDGER.set_state(file_name, ledger.SPLIT)
 
 
 def ee_task_simply_retry(task_id: str):
     with EE_TASK_MONITORING_QUEUE_LOCK:
-        aoi_coords = EE_TASK_MONITORING_QUEUE[task_id]['aoi_coords']
+        bbox = EE_TASK_MONITORING_QUEUE[task_id]['bbox']
         file_name = EE_TASK_MONITORING_QUEUE[task_id]['file_name']
         attempt = EE_TASK_MONITORING_QUEUE[task_id]['attempt'] + 1
         del EE_TASK_MONITORING_QUEUE[task_id]
 
     if attempt > 100:
-        print(f'Task[{task_id}] failed {attempt} times, aborting')
+        log_err(f'Task[{task_id}] failed {attempt} times, aborting', tile=file_name, task_id=task_id,
+                attempt=attempt)
+        LEDGER.set_state(file_name, ledger.FAILED)
         return
 
-    xmin = aoi_coords['xmin']
-    ymin = aoi_coords['ymin']
-    xmax = aoi_coords['xmax']
-    ymax = aoi_coords['ymax']
-
-    aoi = ee.Geometry.Polygon([[[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]])
-    ccdc_input = ccdc_image_collection_preprocess(aoi)
-    ccdc_result = ccdc(ccdc_input, aoi)
-    ccdc_result_flat = ccdc_result_flaten(ccdc_result)
-    ccdc_result_export(ccdc_result_flat, aoi, file_name, attempt)
+    ccdc_bbox_export(bbox, file_name, attempt)
+
+
+def _handle_task_status(task_id: str, task_status: dict):
+    file_name = EE_TASK_MONITORING_QUEUE[task_id]['file_name']
+    fields = {
+        'tile': file_name,
+        'task_id': task_id,
+        'state': task_status['state'],
+        'attempt': EE_TASK_MONITORING_QUEUE[task_id]['attempt'],
+        'latency': round(time.time() - EE_TASK_MONITORING_QUEUE[task_id]['started_at'], 1),
+    }
+    if task_status['state'] in ('COMPLETED', 'FAILED'):
+        CONCURRENCY.record_result(task_status['state'], task_status.get('error_message', ''))
+    if task_status['state'] == 'COMPLETED':
+        log(f'Task {task_id} completed', **fields)
+        LEDGER.set_state(file_name, ledger.COMPLETED)
+        with EE_TASK_MONITORING_QUEUE_LOCK:
+            del EE_TASK_MONITORING_QUEUE[task_id]
+    elif task_status['state'] == 'FAILED':
+        if task_status['error_message'] == 'User memory limit exceeded.':
+            log_err(f'{task_id} Error: User memory limit exceeded, attempt to split.', **fields)
+            ee_task_aoi_split_retry(task_id)
+        elif task_status['error_message'] == 'Execution failed; out of memory.':
+            log_err(f'{task_id} Error: Execution failed, attempt to retry.', **fields)
+            ee_task_simply_retry(task_id)
+        else:
+            log_err(f'Task {task_id} Error: "{task_status["error_message"]}", attempt to skip.', **fields)
+            LEDGER.set_state(file_name, ledger.FAILED)
+            with EE_TASK_MONITORING_QUEUE_LOCK:
+                del EE_TASK_MONITORING_QUEUE[task_id]
+    elif CANCLE_TASK_TO_SPLIT and (
+            task_status['state'] == 'CANCELLED' or task_status['state'] == 'CANCEL_REQUESTED'):
+        log(f'Task {task_id} cancelled, try to split aoi', **fields)
+        ee_task_aoi_split_retry(task_id)
+    elif task_status['state'] == 'CANCELLED' or task_status['state'] == 'CANCEL_REQUESTED':
+        log(f'Task {task_id} cancelled', **fields)
+        LEDGER.set_state(file_name, ledger.CANCELLED)
+        with EE_TASK_MONITORING_QUEUE_LOCK:
+            del EE_TASK_MONITORING_QUEUE[task_id]
+    else:
+        if task_status['state'] == 'RUNNING':
+            CONCURRENCY.record_running(fields['latency'], EE_TASK_MONITORING_QUEUE[task_id]['started_at'])
+        log(f'Task {task_id} {task_status["state"].lower()}', **fields)
+        LEDGER.set_state(file_name, task_status['state'])
+        with EE_TASK_MONITORING_QUEUE_LOCK:
+            EE_TASK_MONITORING_QUEUE[task_id]['state'] = ee.batch.Task.State(task_status['state'])
 
 
 def ee_task_monitor():
-    waits_empty_times = 0
+    """Start queued tasks and track the running ones.
+
+    All tracked tasks are polled with a single task listing per cycle and compared with their last known state. Free
+    slots, up to the limit CONCURRENCY currently allows, are refilled right after a task finishes. The poll interval
+    starts at POLL_INTERVAL and doubles up to MAX_POLL_INTERVAL while no task changes its state. The monitor runs until
+    SUBMISSION_DONE is set and nothing is left, however long planning takes, then logs the pieces of grid tiles which
+    did not complete.
+    """
+    poll_interval = POLL_INTERVAL
     while True:
+        while len(EE_TASK_QUEUE) > 0 and len(EE_TASK_MONITORING_QUEUE) < CONCURRENCY.limit:
+            start_one_task()
         if len(EE_TASK_QUEUE) == 0 and len(EE_TASK_MONITORING_QUEUE) == 0:
-            waits_empty_times += 1
-            if waits_empty_times > 10:
+            if SUBMISSION_DONE.is_set():
                 break
-            else:
-                time.sleep(30)
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        try:
+            task_statuses = utils.get_task_statuses(list(EE_TASK_MONITORING_QUEUE.keys()))
+        except Exception as e:
+            log_err(f'Failed to get task status: {e}')
+            time.sleep(poll_interval)
+            continue
+        changed = False
+        for task_id, task_status in task_statuses.items():
+            if ee.batch.Task.State(task_status['state']) == EE_TASK_MONITORING_QUEUE[task_id]['state']:
                 continue
-        elif len(EE_TASK_QUEUE) > 0 and len(EE_TASK_MONITORING_QUEUE) < MAX_PARALLEL_TASKS:
-            start_one_task()
-        else:
-            waits_empty_times = 0
+            changed = True
+            _handle_task_status(task_id, task_status)
 
-        for task_id in list(EE_TASK_MONITORING_QUEUE.keys()):
-            task = ee.batch.Task(task_id, EE_TASK_MONITORING_QUEUE[task_id]['type'],
-                                 EE_TASK_MONITORING_QUEUE[task_id]['state'])
-            try:
-                task_status = task.status()
-            except Exception as e:
-                print(f'Task {task_id} failed to get status: {e}')
-                time.sleep(30)
+        if changed:
+            poll_interval = POLL_INTERVAL
+            if len(EE_TASK_QUEUE) > 0 and len(EE_TASK_MONITORING_QUEUE) < CONCURRENCY.limit:
                 continue
-            if task_status['state'] == 'COMPLETED':
-                print(f'Task {task_id} completed')
-                with EE_TASK_MONITORING_QUEUE_LOCK:
-                    del EE_TASK_MONITORING_QUEUE[task_id]
-            elif task_status['state'] == 'FAILED':
-                print(f'Task {task_id} failed')
-                if task_status['error_message'] == 'User memory limit exceeded.':
-                    print(f'{task_id} Error: User memory limit exceeded, attempt to split.')
-                    ee_task_aoi_split_retry(task_id)
-                elif task_status['error_message'] == 'Execution failed; out of memory.':
-                    print(f'{task_id} Error: Execution failed, attempt to retry.')
-                    ee_task_simply_retry(task_id)
-                else:
-                    print(f'Task {task_id} Error: "{task_status["error_message"]}", attempt to skip.')
-                    with EE_TASK_MONITORING_QUEUE_LOCK:
-                        del EE_TASK_MONITORING_QUEUE[task_id]
-            elif CANCLE_TASK_TO_SPLIT and (
-                    task_status['state'] == 'CANCELLED' or task_status['state'] == 'CANCEL_REQUESTED'):
-                print(f'Task {task_id} cancelled, try to split aoi')
-                ee_task_aoi_split_retry(task_id)
-            elif task_status['state'] == 'CANCELLED' or task_status['state'] == 'CANCEL_REQUESTED':
-                print(f'Task {task_id} cancelled')
-                with EE_TASK_MONITORING_QUEUE_LOCK:
-                    del EE_TASK_MONITORING_QUEUE[task_id]
-            time.sleep(30)
+        else:
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+        time.sleep(poll_interval)
+
+    incomplete = [name for row in LEDGER.rows() if row['parent'] is None
+                  for name in LEDGER.incomplete(row['file_name'])]
+    if incomplete:
+        log_err(f'{len(incomplete)} tiles were not exported: {", ".join(incomplete)}')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true',
+                      help='Resume the run recorded in the ledger instead of exporting every tile again.')
+    mode.add_argument('--incremental', action='store_true',
+                      help='Only export the tiles whose input scenes changed since the last run.')
+    args = parser.parse_args()
+    tmp_path = 'projects/project_id/assets/CCDC/final_18_0999_tmp'
     task_monitor_thread = threading.Thread(target=ee_task_monitor)
     task_monitor_thread.start()
-    ccdc_main()
+    try:
+        if args.resume:
+            ccdc_main(skip=ee_task_resume())
+        elif args.incremental:
+            LEDGER.reset()
+            ccdc_main(skip=ee_task_incremental([tmp_path]))
+        else:
+            LEDGER.reset()
+            try:
+                # The baseline of the next incremental run
+                LEDGER.record_inputs(tile_inputs())
+            except Exception as e:
+                log_err(f'Failed to record the tile inputs, the next incremental run exports every tile: {e}')
+            ccdc_main()
+    finally:
+        SUBMISSION_DONE.set()
+    task_monitor_thread.join()
     ccdc_result_handler(res_path='projects/project_id/assets/CCDC/ccdc_raw',
         out_path='users/yangluhao990714/ccdc_results/ccdc_5th',
-        tmp_path='projects/project_id/assets/CCDC/final_18_0999_tmp', aoi_path='projects/project_id/assets/AOIs/aoi',
-        max_threads=8, start_year=2015, end_year=2025, )
+        tmp_path=tmp_path, aoi_path='projects/project_id/assets/AOIs/aoi',
+        max_threads=8, start_year=2015, end_year=2025, rebuild_mosaics=args.incremental)
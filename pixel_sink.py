@@ -0,0 +1,211 @@
+"""
+pixel_sink.py
+Download images with `ee.data.computePixels` in chunks, written straight into a memory-mapped array on disk.
+"""
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ee
+import numpy as np
+from geometry import BBox, SCALE_10M
+from utils import log, log_err
+
+MAX_REQUEST_BYTES = 32e6  # Largest computePixels response
+
+
+def chunk_size_for(band_count: int) -> int:
+    """Get the largest chunk side length, a multiple of 64 pixels, whose response fits in a request.
+
+    Args:
+        band_count (int):
+
+    Returns:
+        int:
+
+    Examples:
+        >>> chunk_size_for(1)
+        1984
+        >>> chunk_size_for(80)
+        192
+    """
+    # Pixel values are 8 bytes at most
+    return max(64, int(math.sqrt(MAX_REQUEST_BYTES / (8 * band_count))) // 64 * 64)
+
+
+class ChunkStore:
+    """A (row, column, band) array on disk, filled one chunk at a time.
+
+    The directory holds `pixels.npy`, which is memory-mapped so no chunk stays in RAM once written, and `georef.json`,
+    which records the CRS, the affine transform, the band names and the chunks already written. Opening an existing
+    directory resumes it and ignores the other arguments.
+    """
+
+    def __init__(self, directory: str, bbox: BBox = None, bands: list[str] = None, scale: float = SCALE_10M,
+                 chunk_size: int = 512, crs: str = 'EPSG:4326', dtype: str = 'float32'):
+        """
+        Args:
+            directory (str): Directory of the store.
+            bbox (BBox): Extent of the image.
+            bands (list[str]): Band names.
+            scale (float): Pixel size in CRS units.
+            chunk_size (int): Side length of a chunk in pixels.
+            crs (str):
+            dtype (str): Data type of the stored pixels.
+        """
+        self.directory = directory
+        self._georef_path = os.path.join(directory, 'georef.json')
+        self._lock = threading.Lock()
+        if os.path.exists(self._georef_path):
+            with open(self._georef_path) as f:
+                self.georef = json.load(f)
+            self._pixels = np.lib.format.open_memmap(os.path.join(directory, 'pixels.npy'), mode='r+')
+        else:
+            if bbox is None or not bands:
+                raise ValueError(f'No chunk store in {directory}, bbox and bands are needed to create one')
+            os.makedirs(directory, exist_ok=True)
+            width = max(1, math.ceil(round((bbox.xmax - bbox.xmin) / scale, 6)))
+            height = max(1, math.ceil(round((bbox.ymax - bbox.ymin) / scale, 6)))
+            self.georef = {
+                'crs': crs,
+                'transform': [scale, 0, bbox.xmin, 0, -scale, bbox.ymax],
+                'width': width,
+                'height': height,
+                'bands': list(bands),
+                'chunk_size': chunk_size,
+                'done': [],
+            }
+            self._pixels = np.lib.format.open_memmap(os.path.join(directory, 'pixels.npy'), mode='w+', dtype=dtype,
+                                                     shape=(height, width, len(bands)))
+            self._save()
+        self.done = set(self.georef['done'])
+
+    def _save(self):
+        tmp_path = f'{self._georef_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.georef, f)
+        os.replace(tmp_path, self._georef_path)
+
+    @property
+    def bands(self) -> list[str]:
+        return self.georef['bands']
+
+    @property
+    def chunks(self) -> list[str]:
+        size = self.georef['chunk_size']
+        return [f'{row}_{col}' for row in range(math.ceil(self.georef['height'] / size))
+                for col in range(math.ceil(self.georef['width'] / size))]
+
+    @property
+    def complete(self) -> bool:
+        return len(self.done) == len(self.chunks)
+
+    def window(self, chunk: str) -> tuple[int, int, int, int]:
+        """Get the (row offset, column offset, height, width) of a chunk."""
+        size = self.georef['chunk_size']
+        row, col = (int(i) for i in chunk.split('_'))
+        y0, x0 = row * size, col * size
+        return y0, x0, min(size, self.georef['height'] - y0), min(size, self.georef['width'] - x0)
+
+    def grid(self, chunk: str) -> dict:
+        """Get the `computePixels` pixel grid of a chunk."""
+        scale_x, _, translate_x, _, scale_y, translate_y = self.georef['transform']
+        y0, x0, height, width = self.window(chunk)
+        return {
+            'dimensions': {'width': width, 'height': height},
+            'affineTransform': {
+                'scaleX': scale_x,
+                'shearX': 0,
+                'translateX': translate_x + x0 * scale_x,
+                'shearY': 0,
+                'scaleY': scale_y,
+                'translateY': translate_y + y0 * scale_y,
+            },
+            'crsCode': self.georef['crs'],
+        }
+
+    def write(self, chunk: str, pixels: np.ndarray):
+        """Write a (row, column, band) block into a chunk and record it as done."""
+        y0, x0, height, width = self.window(chunk)
+        self._pixels[y0:y0 + height, x0:x0 + width] = pixels
+        self._pixels.flush()
+        with self._lock:
+            self.done.add(chunk)
+            self.georef['done'] = sorted(self.done)
+            self._save()
+
+    def read(self) -> np.ndarray:
+        """Get the whole array, memory-mapped read-only."""
+        return np.load(os.path.join(self.directory, 'pixels.npy'), mmap_mode='r')
+
+
+def finished_stores(directory: str) -> set[str]:
+    """Get the names of the ChunkStores directly under a directory which have every chunk written.
+
+    Args:
+        directory (str):
+
+    Returns:
+        set[str]:
+    """
+    if not os.path.isdir(directory):
+        return set()
+    return {name for name in os.listdir(directory)
+            if os.path.exists(os.path.join(directory, name, 'georef.json'))
+            and ChunkStore(os.path.join(directory, name)).complete}
+
+
+def download_image(image: ee.Image, directory: str, bbox: BBox, bands: list[str], scale: float = SCALE_10M,
+                   chunk_size: int = None, max_workers: int = 8, max_attempts: int = 5) -> bool:
+    """Download an image into a ChunkStore, resuming the chunks a previous call did not finish.
+
+    Chunks are fetched by a pool of max_workers threads, each one up to max_attempts times with exponential backoff.
+
+    Args:
+        image (ee.Image): Image to download.
+        directory (str): Directory of the ChunkStore.
+        bbox (BBox): Extent to download.
+        bands (list[str]): Bands to download.
+        scale (float): Pixel size in degrees. Defaults to 10 m.
+        chunk_size (int): Side length of a chunk in pixels. Defaults to the largest one fitting in a request.
+        max_workers (int): Maximum number of requests in flight. Defaults to 8.
+        max_attempts (int): Number of requests for a chunk before giving up. Defaults to 5.
+
+    Returns:
+        bool: Whether every chunk was written.
+    """
+    store = ChunkStore(directory, bbox, bands, scale, chunk_size or chunk_size_for(len(bands)))
+    pending = [chunk for chunk in store.chunks if chunk not in store.done]
+    name = os.path.basename(directory.rstrip('/'))
+
+    def fetch(chunk: str) -> bool:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                block = ee.data.computePixels({
+                    'expression': image,
+                    'fileFormat': 'NUMPY_NDARRAY',
+                    'bandIds': store.bands,
+                    'grid': store.grid(chunk),
+                })
+                store.write(chunk, np.stack([block[band] for band in store.bands], axis=-1))
+                return True
+            except Exception as e:
+                if attempt == max_attempts:
+                    log_err(f'Failed to download chunk {chunk} of {name}: {e}', tile=name, attempt=attempt)
+                    return False
+                time.sleep(min(2 ** attempt, 60))
+        return False
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        ok = all(list(pool.map(fetch, pending)))
+    log(f'Downloaded {name}' if ok else f'Download of {name} is incomplete', tile=name,
+        state='COMPLETED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,108 @@
+"""
+priority_queue.py
+Bounded, thread-safe priority queue of pending exports.
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+
+def retries_then_largest(item: dict) -> tuple:
+    """Priority of an export: retries and split pieces first, by attempt, then the costliest tiles.
+
+    Lower sorts first, equal priorities keep their insertion order.
+
+    Args:
+        item (dict): Export with an `attempt` and a `cost`.
+
+    Returns:
+        tuple:
+    """
+    return -item.get('attempt', 1), -item.get('cost', 0.0)
+
+
+class PriorityQueue:
+    """Heap-ordered queue, `get` returns the item with the lowest `priority(item)`, the oldest one among equals.
+
+    `put` blocks while `maxsize` items are waiting and `get` blocks while there is none, like `queue.Queue`.
+
+    Examples:
+        >>> q = PriorityQueue(maxsize=2)
+        >>> q.put({'name': 'a', 'attempt': 1, 'cost': 1.0})
+        >>> q.put({'name': 'b', 'attempt': 1, 'cost': 4.0})
+        >>> q.put({'name': 'c', 'attempt': 1, 'cost': 9.0}, block=False)
+        Traceback (most recent call last):
+        ...
+        queue.Full
+        >>> q.put({'name': 'retry', 'attempt': 2, 'cost': 1.0}, force=True)
+        >>> [q.get()['name'] for _ in range(len(q))]
+        ['retry', 'b', 'a']
+    """
+
+    def __init__(self, maxsize: int = 0, priority: Callable[[Any], Any] = retries_then_largest):
+        """
+        Args:
+            maxsize (int): Number of items waiting at most, unbounded if 0.
+            priority (Callable[[Any], Any]): Sort key of an item, computed once when it is put.
+        """
+        self.maxsize = maxsize
+        self.priority = priority
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._heap)
+
+    def _full(self) -> bool:
+        return 0 < self.maxsize <= len(self._heap)
+
+    def put(self, item, block: bool = True, timeout: float = None, force: bool = False):
+        """Add an item.
+
+        Args:
+            item: Item to add.
+            block (bool): Wait for room if the queue is full, otherwise raise `queue.Full`.
+            timeout (float): Seconds to wait for room at most, forever if None.
+            force (bool): Add the item even if the queue is full. A consumer putting items back must use it, it would
+                otherwise wait for itself.
+        """
+        with self._not_full:
+            if not force and self._full():
+                if not block:
+                    raise queue.Full
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._full():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Full
+                    self._not_full.wait(remaining)
+            heapq.heappush(self._heap, (self.priority(item), next(self._seq), item))
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """Remove and return the item of the highest priority.
+
+        Args:
+            block (bool): Wait for an item if the queue is empty, otherwise raise `queue.Empty`.
+            timeout (float): Seconds to wait for an item at most, forever if None.
+        """
+        with self._not_empty:
+            if not self._heap:
+                if not block or not self._not_empty.wait_for(lambda: self._heap, timeout):
+                    raise queue.Empty
+            item = heapq.heappop(self._heap)[2]
+            self._not_full.notify()
+            return item
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,146 @@
+"""
+quadkey.py
+Quadtree addressing of tiles on a fixed global 10 m pixel grid in EPSG:4326.
+
+The level 0 cell has its top left corner at (-180, 90) and is 2 ** MAX_LEVEL pixels wide, which covers the globe. Each
+level halves the cells, a cell's quadkey is the one of its parent plus a digit, 0 top left, 1 top right, 2 bottom left
+and 3 bottom right. Cell edges are whole pixels down to level MAX_LEVEL, so tiles split along cells stay on the pixel
+grid of the exports, and sorting quadkeys orders cells along a Z curve.
+"""
+import math
+from geometry import BBox, SCALE_10M
+
+ORIGIN = (-180.0, 90.0)  # Top left corner of the level 0 cell
+MAX_LEVEL = 22  # Level of the single pixel cells
+CRS_TRANSFORM = [SCALE_10M, 0, ORIGIN[0], 0, -SCALE_10M, ORIGIN[1]]  # Pixel grid of the exports
+
+
+def _pixel_window(bbox: BBox) -> tuple[int, int, int, int]:
+    # (left, top, right, bottom) in whole pixels from the origin, snapped outwards
+    return (math.floor(round((bbox.xmin - ORIGIN[0]) / SCALE_10M, 6)),
+            math.floor(round((ORIGIN[1] - bbox.ymax) / SCALE_10M, 6)),
+            math.ceil(round((bbox.xmax - ORIGIN[0]) / SCALE_10M, 6)),
+            math.ceil(round((ORIGIN[1] - bbox.ymin) / SCALE_10M, 6)))
+
+
+def _window_bbox(left: int, top: int, right: int, bottom: int) -> BBox:
+    return BBox(ORIGIN[0] + left * SCALE_10M, ORIGIN[1] - bottom * SCALE_10M,
+                ORIGIN[0] + right * SCALE_10M, ORIGIN[1] - top * SCALE_10M)
+
+
+def _clipped_window(bbox: BBox, key: str) -> tuple[int, int, int, int]:
+    # Pixel window of a tile, clipped to the cell of its key
+    left, top, right, bottom = _pixel_window(bbox)
+    if key:
+        col, row, level = _cell(key)
+        side = 2 ** (MAX_LEVEL - level)
+        left, top = max(left, col * side), max(top, row * side)
+        right, bottom = min(right, (col + 1) * side), min(bottom, (row + 1) * side)
+    return left, top, right, bottom
+
+
+def _cell(key: str) -> tuple[int, int, int]:
+    col = row = 0
+    for digit in key:
+        if digit not in '0123':
+            raise ValueError(f'Invalid quadkey [{key}]')
+        col, row = col * 2 + (int(digit) & 1), row * 2 + (int(digit) >> 1)
+    return col, row, len(key)
+
+
+def _key(col: int, row: int, level: int) -> str:
+    return ''.join(str((col >> i & 1) | (row >> i & 1) << 1) for i in range(level - 1, -1, -1))
+
+
+def snap(bbox: BBox) -> BBox:
+    """Grow a bounding box to the edges of the pixels it touches.
+
+    Examples:
+        >>> box = snap(BBox(90.00004, 30.0, 90.1, 30.1))
+        >>> [round((box.xmin - ORIGIN[0]) / SCALE_10M, 6), round((box.xmax - ORIGIN[0]) / SCALE_10M, 6)]
+        [3005626.0, 3006740.0]
+    """
+    return _window_bbox(*_pixel_window(bbox))
+
+
+def split(bbox: BBox, key: str = '', levels: int = 1) -> list[tuple[str, BBox]]:
+    """Split a tile into the cells of the global grid it overlaps, each one clipped to the tile.
+
+    The tile, clipped to the cell of its key, is cut into the children of the smallest cell containing it, so it spans
+    at most 2 cells per axis and gives 2 to 4 pieces. Each further level doubles that per axis. The cuts follow the
+    grid, not the middle of the tile, so a piece may be a sliver along the edge of the tile, see `split_evenly`. Pixels
+    never get split.
+
+    Args:
+        bbox (BBox): Extent of the tile, snapped outwards to the pixel grid.
+        key (str): Quadkey of the tile, '' for a cell of the AOI grid.
+        levels (int): Number of levels to descend. Defaults to 1.
+
+    Returns:
+        list[tuple[str, BBox]]: (quadkey, extent) of the pieces, in Z-order. Just the tile itself if it is one pixel.
+
+    Examples:
+        >>> pieces = split(BBox(90.0, 30.0, 90.1, 30.1))
+        >>> len(pieces), {len(key) for key, _ in pieces}
+        (2, {9})
+        >>> children = split(pieces[0][1], pieces[0][0])
+        >>> 2 <= len(children) <= 4, all(key.startswith(pieces[0][0]) for key, _ in children)
+        (True, True)
+        >>> round(sum(box.area() for _, box in pieces) / snap(BBox(90.0, 30.0, 90.1, 30.1)).area(), 9)
+        1.0
+    """
+    left, top, right, bottom = _clipped_window(bbox, key)
+    # Side of the smallest cell containing the tile, as the highest bit where its first and last pixels differ
+    bits = max((left ^ (right - 1)).bit_length(), (top ^ (bottom - 1)).bit_length())
+    if bits == 0:
+        return [(key, _window_bbox(left, top, right, bottom))]
+    level = min(MAX_LEVEL - bits + levels, MAX_LEVEL)
+    side = 2 ** (MAX_LEVEL - level)
+    pieces = []
+    for row in range(top // side, (bottom - 1) // side + 1):
+        for col in range(left // side, (right - 1) // side + 1):
+            pieces.append((_key(col, row, level), _window_bbox(max(left, col * side), max(top, row * side),
+                                                               min(right, (col + 1) * side),
+                                                               min(bottom, (row + 1) * side))))
+    return sorted(pieces)
+
+
+def split_evenly(bbox: BBox, key: str = '', max_fraction: float = 0.25) -> list[tuple[str, BBox]]:
+    """Split a tile along the global grid, descending levels until no piece holds more than max_fraction of its pixels.
+
+    A single `split` cuts at the first cell edge inside the tile, which may leave one piece with almost all of it.
+
+    Args:
+        bbox (BBox): Extent of the tile, snapped outwards to the pixel grid.
+        key (str): Quadkey of the tile, '' for a cell of the AOI grid.
+        max_fraction (float): Largest share of the tile's pixels in one piece. Defaults to 0.25.
+
+    Returns:
+        list[tuple[str, BBox]]: (quadkey, extent) of the pieces, in Z-order. Just the tile itself if it is one pixel.
+
+    Examples:
+        >>> tile = BBox(65.9745, 50.0867, 66.0745, 50.1867)
+        >>> round(max(_pixels(box) for _, box in split(tile)) / _pixels(tile), 4)
+        0.9991
+        >>> pieces = split_evenly(tile)
+        >>> len(pieces), max(_pixels(box) for _, box in pieces) / _pixels(tile) <= 0.25
+        (12, True)
+    """
+    total = _pixels(bbox, key)
+    for levels in range(1, MAX_LEVEL + 1):
+        pieces = split(bbox, key, levels)
+        largest = max(_pixels(box) for _, box in pieces)
+        if largest <= total * max_fraction or largest == 1:
+            break
+    return pieces
+
+
+def _pixels(bbox: BBox, key: str = '') -> int:
+    left, top, right, bottom = _clipped_window(bbox, key)
+    return (right - left) * (bottom - top)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
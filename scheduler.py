@@ -0,0 +1,320 @@
+"""
+scheduler.py
+Shared, non-blocking scheduler for EE export tasks.
+"""
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import Callable
+import ee
+import utils
+from utils import log, log_err
+
+
+def classify_error(message: str) -> str:
+    """Group an EE task error message by its cause.
+
+    Args:
+        message (str): `error_message` of a failed task.
+
+    Returns:
+        str: One of 'tile_memory' (the computation of the tile itself is too large), 'memory', 'rate', 'timeout',
+            'exists' and 'other'.
+
+    Examples:
+        >>> classify_error('User memory limit exceeded.')
+        'tile_memory'
+        >>> classify_error('Execution failed; out of memory.')
+        'memory'
+        >>> classify_error('Too many tasks already in the queue (3000). Please wait for some of them to complete.')
+        'rate'
+        >>> classify_error('Computation timed out.')
+        'timeout'
+    """
+    message = message.lower()
+    if 'user memory limit' in message:
+        return 'tile_memory'
+    if 'memory' in message:
+        return 'memory'
+    if 'too many' in message or 'quota' in message or 'rate limit' in message:
+        return 'rate'
+    if 'timed out' in message:
+        return 'timeout'
+    if 'cannot overwrite asset' in message:
+        return 'exists'
+    return 'other'
+
+
+class ConcurrencyController:
+    """Additive-increase/multiplicative-decrease limit on the number of EE exports in flight.
+
+    Until the first back-off every completed task raises the limit by 1, doubling it every round of tasks, then by
+    `increase / limit`, about `increase` per round, as long as tasks leave READY within `target_ready_latency` seconds
+    on average. An average READY latency above the target, or out-of-memory, rate limit and timeout failures making up
+    more than `max_failure_rate` of the recent results, multiply the limit by `decrease`, at most once every `cooldown`
+    seconds. Failures of a tile being too large for EE say nothing about load and are only counted. The limit stays
+    within [floor, ceiling].
+    """
+
+    _BACKOFF_ERRORS = ('memory', 'rate', 'timeout')
+
+    def __init__(self, initial: int = 10, floor: int = 1, ceiling: int = 100, increase: float = 1.0,
+                 decrease: float = 0.5, target_ready_latency: float = 600, max_failure_rate: float = 0.1,
+                 cooldown: float = 300, window: float = 3600, clock=None):
+        """
+        Args:
+            initial (int): Limit to start with.
+            floor (int): Lowest limit.
+            ceiling (int): Highest limit.
+            increase (float): Limit added per round of completed tasks.
+            decrease (float): Factor the limit is multiplied with on congestion.
+            target_ready_latency (float): Highest average seconds from READY to RUNNING before backing off.
+            max_failure_rate (float): Highest share of recent results failing from load before backing off.
+            cooldown (float): Seconds between two decreases.
+            window (float): Seconds the completion rate and the failure counts look back.
+            clock: Provides `time()`, defaults to the `time` module.
+        """
+        self.floor = floor
+        self.ceiling = ceiling
+        self.increase = increase
+        self.decrease = decrease
+        self.target_ready_latency = target_ready_latency
+        self.max_failure_rate = max_failure_rate
+        self.cooldown = cooldown
+        self.window = window
+        self.clock = clock or time
+        self._limit = float(min(max(initial, floor), ceiling))
+        self._ready_latency = None
+        self._completions = deque()
+        self._failures = deque()
+        self._decreased_at = None
+        self._slow_start = True
+        self._decision = 'hold'
+        self._reason = 'initial'
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        """Current number of exports allowed in flight."""
+        with self._lock:
+            return int(self._limit)
+
+    def _forget(self, now: float):
+        while self._completions and self._completions[0] < now - self.window:
+            self._completions.popleft()
+        while self._failures and self._failures[0][0] < now - self.window:
+            self._failures.popleft()
+
+    def _back_off(self, now: float, reason: str):
+        if self._decreased_at is not None and now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self._slow_start = False
+        self._set(max(self.floor, self._limit * self.decrease), 'decrease', reason)
+
+    def _set(self, limit: float, decision: str, reason: str):
+        old = int(self._limit)
+        self._limit = limit
+        self._decision, self._reason = decision, reason
+        if int(limit) != old:
+            log(f'Concurrency limit {old} -> {int(limit)} ({reason})', state=decision, limit=int(limit))
+
+    def record_running(self, ready_latency: float, started_at: float = None):
+        """Record a task which left READY after ready_latency seconds.
+
+        Tasks started before the last back-off waited behind the previous limit and are ignored.
+        """
+        with self._lock:
+            if started_at is not None and self._decreased_at is not None and started_at < self._decreased_at:
+                return
+            if self._ready_latency is None:
+                self._ready_latency = ready_latency
+            else:
+                self._ready_latency = 0.8 * self._ready_latency + 0.2 * ready_latency
+            if self._ready_latency > self.target_ready_latency:
+                self._back_off(self.clock.time(), f'ready latency {self._ready_latency:.0f}s')
+
+    def record_result(self, state: str, error_message: str = ''):
+        """Record a finished task, by its final state and error message."""
+        with self._lock:
+            now = self.clock.time()
+            self._forget(now)
+            if state == 'COMPLETED':
+                self._completions.append(now)
+                if self._ready_latency is None or self._ready_latency <= self.target_ready_latency:
+                    step = 1 if self._slow_start else self.increase / self._limit
+                    self._set(min(self.ceiling, self._limit + step), 'increase', 'completed')
+            elif state == 'FAILED':
+                error = classify_error(error_message)
+                self._failures.append((now, error))
+                load_failures = sum(1 for _, e in self._failures if e in self._BACKOFF_ERRORS)
+                results = len(self._completions) + len(self._failures)
+                if error in self._BACKOFF_ERRORS and load_failures > self.max_failure_rate * max(results, 10):
+                    self._back_off(now, f'{load_failures} of {results} recent tasks failed from load')
+
+    def snapshot(self) -> dict:
+        """Get the current decision and the signals behind it, for monitoring."""
+        with self._lock:
+            now = self.clock.time()
+            self._forget(now)
+            return {
+                'limit': int(self._limit),
+                'decision': self._decision,
+                'reason': self._reason,
+                'ready_latency': None if self._ready_latency is None else round(self._ready_latency, 1),
+                'completions_per_hour': round(len(self._completions) * 3600 / self.window, 2),
+                'failures': dict(Counter(error for _, error in self._failures)),
+            }
+
+
+class ExportScheduler:
+    """Keep up to `max_concurrent` EE export tasks in flight from a single background thread.
+
+    Callers submit a function creating the task and get a `concurrent.futures.Future` back. The future resolves to
+    True once the task completed, or the asset already exists, and to False once it failed `max_attempts` times or was
+    cancelled. All running tasks are polled with one task listing per cycle. The poll interval doubles from
+    `poll_interval` up to `max_poll_interval` while nothing changes.
+    """
+
+    def __init__(self, max_concurrent: int = 32, poll_interval: float = 10, max_poll_interval: float = 120,
+                 clock=None, controller: ConcurrencyController = None):
+        """
+        Args:
+            max_concurrent (int): Maximum number of tasks in flight, unless a controller sets it.
+            poll_interval (float): Seconds between two polls right after a task finished.
+            max_poll_interval (float): Seconds between two polls at most.
+            clock: Provides `time()` and `sleep()`, defaults to the `time` module.
+            controller (ConcurrencyController): Adapts the number of tasks in flight to how EE copes with them.
+        """
+        self.max_concurrent = max_concurrent
+        self.controller = controller
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.clock = clock or time
+        self._pending = deque()
+        self._running: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, make_task: Callable[[], ee.batch.Task], max_attempts: int = 1, name: str = None) -> Future:
+        """Queue an export.
+
+        Args:
+            make_task (Callable[[], ee.batch.Task]): Creates the unstarted task, called again for every attempt.
+            max_attempts (int): Number of times the task is started before it counts as failed.
+            name (str): Name of the export in the logs.
+
+        Returns:
+            Future: Resolves to True if the export succeeded, False otherwise.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Cannot submit to a closed ExportScheduler')
+            self._pending.append({'make_task': make_task, 'future': future, 'attempt': 1,
+                                  'max_attempts': max_attempts, 'name': name})
+        return future
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._running)
+
+    def _limit(self) -> int:
+        return self.controller.limit if self.controller else self.max_concurrent
+
+    def _start_pending(self):
+        # Tasks are created and started outside the lock, so submit() and status updates never wait on EE requests
+        with self._lock:
+            jobs = []
+            while self._pending and len(self._running) + len(jobs) < self._limit():
+                jobs.append(self._pending.popleft())
+        for job in jobs:
+            try:
+                task = job['make_task']()
+                task.start()
+            except Exception as e:
+                log_err(f'Failed to start {job["name"]}: {e}', tile=job['name'], attempt=job['attempt'])
+                with self._lock:
+                    self._finish(job, False)
+                continue
+            job['started_at'] = self.clock.time()
+            job.pop('running_at', None)
+            with self._lock:
+                self._running[task.id] = job
+            log(f'Task {task.id} started', tile=job['name'], task_id=task.id, state='READY', attempt=job['attempt'])
+
+    def _finish(self, job: dict, success: bool):
+        if not success and job['attempt'] < job['max_attempts']:
+            job['attempt'] += 1
+            self._pending.append(job)
+            return
+        job['future'].set_result(success)
+
+    def _handle_status(self, task_id: str, status: dict) -> bool:
+        if status['state'] not in ('COMPLETED', 'FAILED', 'CANCELLED'):
+            job = self._running[task_id]
+            if status['state'] == 'RUNNING' and 'running_at' not in job:
+                job['running_at'] = self.clock.time()
+                if self.controller:
+                    self.controller.record_running(job['running_at'] - job['started_at'], job['started_at'])
+            return False
+        job = self._running.pop(task_id)
+        if self.controller:
+            self.controller.record_result(status['state'], status.get('error_message', ''))
+        fields = {'tile': job['name'], 'task_id': task_id, 'state': status['state'], 'attempt': job['attempt'],
+                  'latency': round(self.clock.time() - job['started_at'], 1)}
+        if status['state'] == 'COMPLETED':
+            log(f'Task {task_id} completed', **fields)
+            self._finish(job, True)
+        elif status['state'] == 'FAILED' and 'Cannot overwrite asset' in status.get('error_message', ''):
+            log(f'Task {task_id} found its asset already exists', **fields)
+            self._finish(job, True)
+        elif status['state'] == 'CANCELLED':
+            log_err(f'Task {task_id} cancelled', **fields)
+            job['future'].set_result(False)
+        else:
+            log_err(f'Task {task_id} failed: {status.get("error_message", "")}', **fields)
+            self._finish(job, False)
+        return True
+
+    def _run(self):
+        poll_interval = self.poll_interval
+        next_poll = self.clock.time()
+        while True:
+            self._start_pending()
+            with self._lock:
+                if self._closed and not self._pending and not self._running:
+                    return
+                task_ids = list(self._running)
+            # Wake up at least every second to start new submissions
+            if not task_ids:
+                self.clock.sleep(1)
+                continue
+            if self.clock.time() < next_poll:
+                self.clock.sleep(min(1, next_poll - self.clock.time()))
+                continue
+            try:
+                statuses = utils.get_task_statuses(task_ids)
+            except Exception as e:
+                log_err(f'Failed to get task status: {e}')
+                statuses = {}
+            with self._lock:
+                changed = [self._handle_status(task_id, status) for task_id, status in statuses.items()]
+            poll_interval = self.poll_interval if any(changed) else min(poll_interval * 2, self.max_poll_interval)
+            next_poll = self.clock.time() + poll_interval
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting exports, the queued and running ones are still seen through."""
+        with self._lock:
+            self._closed = True
+        if wait:
+            self._thread.join()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -5,12 +5,107 @@ Author: Luhao Yang
 Date: 2025-01-09
 """
 import ee
+import atexit
 import datetime
+import json
+import os
+import queue
+import sys
+import threading
 from tqdm import tqdm
 from typing import Literal
 from time import sleep
 
 
+class LogWriter:
+    """A single background thread writing structured JSON lines to the log files.
+
+    Records are fed through a bounded queue, so a burst of messages blocks the producers instead of growing without
+    limit, and are written and flushed in batches. Every record is also echoed to stdout in a readable form.
+    """
+
+    def __init__(self, log_dir: str = './log', max_queue: int = 10000, batch_size: int = 256, echo: bool = True):
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.echo = echo
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._files = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, file_name: str, record: dict):
+        self._queue.put((file_name, record))
+
+    def _write_batch(self, batch: list):
+        for file_name, record in batch:
+            if file_name not in self._files:
+                os.makedirs(self.log_dir, exist_ok=True)
+                self._files[file_name] = open(os.path.join(self.log_dir, file_name), 'a')
+            self._files[file_name].write(json.dumps(record, default=str) + '\n')
+            if self.echo:
+                sys.stdout.write(f'[{record["time"]}] [{record["function"]}]: {record["msg"]}\n')
+        for f in self._files.values():
+            f.flush()
+        if self.echo:
+            sys.stdout.flush()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            self._write_batch([item for item in batch if item is not None])
+            if stop:
+                break
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+LOG_WRITER = LogWriter()
+
+
+def _log_record(level: str, msg: str, fields: dict) -> dict:
+    record = {
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'level': level,
+        'function': sys._getframe(2).f_code.co_name,
+        'msg': msg,
+    }
+    record.update({k: v for k, v in fields.items() if v is not None})
+    return record
+
+
+def log(msg: str, **fields):
+    """Write a message to ./log/log.log through the shared background writer.
+
+    Args:
+        msg (str):
+        **fields: Structured fields of the record, e.g. tile, task_id, state, attempt, latency.
+    """
+    LOG_WRITER.write('log.log', _log_record('INFO', msg, fields))
+
+
+def log_err(msg: str, **fields):
+    """Write a message to ./log/err.log through the shared background writer.
+
+    Args:
+        msg (str):
+        **fields: Structured fields of the record, e.g. tile, task_id, state, attempt, latency.
+    """
+    LOG_WRITER.write('err.log', _log_record('ERROR', msg, fields))
+
+
 def ee_init(project: str):
     """Initialize EE project.
 
@@ -241,22 +336,57 @@ def band_rename(self, collection_title) -> ee.ImageCollection:
 ee.ImageCollection.band_rename = band_rename
 
 
-def remove_clouds(self, collection_title) -> ee.ImageCollection:
-    """Remove clouds from the input image collection.
+CLOUD_SCORE_PLUS_COLLECTION = 'GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED'
+
+
+def remove_clouds(self, collection_title, strategy: Literal['link', 'join', 'filter'] = 'link',
+                  threshold: float = 0.5, qa_band: Literal['cs', 'cs_cdf'] = 'cs', aoi: ee.Geometry = None,
+                  start_date: ee.Date = None, end_date: ee.Date = None) -> ee.ImageCollection:
+    """Remove clouds from the input image collection with Cloud Score+.
+
+    The strategies only differ in how each image is matched with its Cloud Score+ image:
+        - 'link': `linkCollection` on `system:index`, the QA band is added to each image.
+        - 'join': a saveFirst join on `system:index`. The Cloud Score+ collection is bounded by `aoi` and the dates
+          first if they are given. Images without a Cloud Score+ image are dropped.
+        - 'filter': filter the whole Cloud Score+ collection for every image, the original behaviour.
 
     Args:
         collection_title (str):
+        strategy (Literal['link', 'join', 'filter']): Defaults to 'link'.
+        threshold (float): Pixels with a QA value not above it are masked. Defaults to 0.5.
+        qa_band (Literal['cs', 'cs_cdf']): Cloud Score+ band to threshold. Defaults to 'cs'.
+        aoi (ee.Geometry): Bounds of the Cloud Score+ collection for the 'join' strategy.
+        start_date (ee.Date): Start date of the Cloud Score+ collection for the 'join' strategy.
+        end_date (ee.Date): End date of the Cloud Score+ collection for the 'join' strategy.
 
     Returns:
         ee.ImageCollection:
+
+    Raises:
+        ValueError: If the strategy is not one of the above.
     """
     match collection_title:
-        case 'COPERNICUS/S2_SR_HARMONIZED':
-            cloud_collection = ee.ImageCollection("GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED")
-            self = self.map(lambda img: img.updateMask(cloud_collection.filter(ee.Filter.eq("system:index", img.get("system:index"))).first().select("cs").gt(0.5)))
-        case 'COPERNICUS/S2_HARMONIZED':
-            cloud_collection = ee.ImageCollection("GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED")
-            self = self.map(lambda img: img.updateMask(cloud_collection.filter(ee.Filter.eq("system:index", img.get("system:index"))).first().select("cs").gt(0.5)))
+        case 'COPERNICUS/S2_SR_HARMONIZED' | 'COPERNICUS/S2_HARMONIZED':
+            cloud_collection = ee.ImageCollection(CLOUD_SCORE_PLUS_COLLECTION)
+            match strategy:
+                case 'link':
+                    self = self.linkCollection(cloud_collection, [qa_band])
+                    self = self.map(lambda img: img.updateMask(img.select(qa_band).gt(threshold)))
+                case 'join':
+                    if aoi is not None:
+                        cloud_collection = cloud_collection.filterBounds(aoi)
+                    if start_date is not None and end_date is not None:
+                        cloud_collection = cloud_collection.filterDate(start_date, end_date)
+                    joined = ee.Join.saveFirst('cloud_score').apply(
+                        self, cloud_collection, ee.Filter.equals(leftField='system:index', rightField='system:index'))
+                    self = ee.ImageCollection(joined).map(lambda img: img.updateMask(
+                        ee.Image(img.get('cloud_score')).select(qa_band).gt(threshold)))
+                case 'filter':
+                    self = self.map(lambda img: img.updateMask(cloud_collection.filter(
+                        ee.Filter.eq("system:index", img.get("system:index"))).first().select(qa_band).gt(threshold)))
+                case _:
+                    # Going on without a cloud mask would run CCDC on cloudy inputs
+                    raise ValueError(f'The cloud removal strategy [{strategy}] is not supported.')
         case _:
             print(f'The input image collection [{collection_title}] is not supported.')
     return self
@@ -405,24 +535,30 @@ ee.ImageCollection.temporal_composite = temporal_composite
 
 
 def year_to_millis(year: float) -> int:
-    """Convert a decimal year to milliseconds since the epoch.
+    """Convert a decimal year, in UTC, to milliseconds since the epoch.
 
     Args:
         year (float): The decimal year (e.g., 2023.17)
 
     Returns:
         int: The corresponding milliseconds since the epoch
+
+    Examples:
+        >>> year_to_millis(2020.5) - year_to_millis(2020)
+        15811200000
+        >>> year_to_millis(1970.0)
+        0
     """
     # 提取年份和小数部分
     year_int = int(year)
     decimal_part = year - year_int
 
-    # 计算该年份的总天数
-    start_of_year = datetime.datetime(year_int, 1, 1)
-    end_of_year = datetime.datetime(year_int + 1, 1, 1)
-    microseconds_in_year = (end_of_year - start_of_year).microseconds
+    # 计算该年份的总微秒数, timedelta.microseconds 只是不足一秒的部分
+    start_of_year = datetime.datetime(year_int, 1, 1, tzinfo=datetime.timezone.utc)
+    end_of_year = datetime.datetime(year_int + 1, 1, 1, tzinfo=datetime.timezone.utc)
+    microseconds_in_year = (end_of_year - start_of_year).total_seconds() * 1e6
 
-    # 计算小数部分对应的天数
+    # 计算小数部分对应的微秒数
     microseconds = decimal_part * microseconds_in_year
 
     # 计算目标日期
@@ -505,17 +641,45 @@ def year_to_date(year: float, fmt: str = '%Y-%m-%dT%H:%M:%S') -> str:
     return ret
 
 
-def del_ee_forder(path: str):
+def iter_asset_names(parent: str, page_size: int = 1000):
+    """Stream the names of the assets directly under an EE folder or image collection, one page per request.
+
+    Args:
+        parent (str): EE folder or image collection.
+        page_size (int): Number of assets fetched per request. Defaults to 1000.
+
+    Yields:
+        str: Full asset name.
+    """
+    params = {'parent': parent, 'pageSize': page_size}
+    while True:
+        page = ee.data.listAssets(params)
+        for asset in page.get('assets', []):
+            yield asset['name']
+        if not page.get('nextPageToken'):
+            return
+        params['pageToken'] = page['nextPageToken']
+
+
+def del_ee_forder(path: str, catalog=None):
     """
     Args:
         path (str): EE path to be deleted
+        catalog (AssetCatalog): Asset listing cache, refreshed for path and kept up to date with the deletions.
+            Defaults to None.
     """
-    assets = ee.data.listAssets(path)
-    assets_dict = assets['assets']
-    assets_dict.append({'name': path})
+    path = path.rstrip('/')
+    if catalog:
+        # A stale listing misses new assets, so the folder cannot be deleted, and lists deleted ones, which raise
+        assets = [f'{path}/{name}' for name in sorted(catalog.names(path, refresh=True))]
+    else:
+        assets = list(iter_asset_names(path))
+    assets.append(path)
     print(f'⚠️deleting folder {path}')
-    for asset in tqdm(assets_dict):
-        ee.data.deleteAsset(asset['name'])
+    for asset in tqdm(assets):
+        ee.data.deleteAsset(asset)
+        if catalog:
+            catalog.remove(asset)
 
 
 def del_ee_image_collection(path: str):
@@ -556,6 +720,22 @@ def create_ee_image_collection_with_overwrite(path: str):
         ee.data.createAsset({'type': ee.data.ASSET_TYPE_IMAGE_COLL}, path)
 
 
+def get_task_statuses(task_ids) -> dict[str, dict]:
+    """Get the status of many tasks with one task listing instead of one `Task.status()` call per task.
+
+    Args:
+        task_ids (Iterable[str]): Ids of the tasks to look up.
+
+    Returns:
+        dict[str, dict]: Task id to its status dict, same fields as `ee.batch.Task.status()`. Tasks which are not listed
+            yet are left out.
+    """
+    task_ids = set(task_ids)
+    if not task_ids:
+        return {}
+    return {status['id']: status for status in ee.data.getTaskList() if status['id'] in task_ids}
+
+
 def start_task_and_monitoring(task: ee.batch.Task, sleep_time: int = 30) -> bool:
     task.start()
     while True:
@@ -0,0 +1,131 @@
+"""
+year_fraction.py
+Vectorized conversions between fractional years, as CCDC writes its tBreak bands with dateFormat=1, and dates.
+
+A fractional year is the year plus the elapsed part of it, so leap years stretch the fraction over 366 days. All
+conversions work on whole NumPy arrays in UTC. Mask tBreak values of 0, which mean no break, before converting.
+"""
+import numpy as np
+
+MILLIS_PER_DAY = 86400000
+
+
+def _year_start_millis(year: np.ndarray) -> np.ndarray:
+    return (year - 1970).astype('datetime64[Y]').astype('datetime64[ms]').astype(np.int64)
+
+
+def _split(years) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    years = np.asarray(years, dtype=float)
+    finite = np.isfinite(years)
+    year = np.floor(np.where(finite, years, 1970)).astype(np.int64)
+    return years, year, finite
+
+
+def years_to_millis(years) -> np.ndarray:
+    """Convert fractional years to milliseconds since the epoch.
+
+    Args:
+        years (array_like): Fractional years.
+
+    Returns:
+        np.ndarray: int64 milliseconds, rounded to the nearest one.
+
+    Raises:
+        ValueError: If a year is not finite.
+
+    Examples:
+        >>> years_to_millis([2021.0, 2020.5, 2021.5])
+        array([1609459200000, 1593648000000, 1625227200000])
+        >>> import utils
+        >>> years = np.random.default_rng(0).uniform(1971, 2037, 1000)
+        >>> bool(np.all(np.abs(years_to_millis(years) - [utils.year_to_millis(y) for y in years]) <= 1))
+        True
+    """
+    years, year, finite = _split(years)
+    if not finite.all():
+        raise ValueError('Cannot convert non-finite years to milliseconds')
+    start = _year_start_millis(year)
+    length = _year_start_millis(year + 1) - start
+    return start + np.rint((years - year) * length).astype(np.int64)
+
+
+def years_to_datetime64(years) -> np.ndarray:
+    """Convert fractional years to datetime64[ms], NaT where a year is not finite.
+
+    Examples:
+        >>> print(years_to_datetime64([2020.5, np.nan]))
+        ['2020-07-02T00:00:00.000'                     'NaT']
+    """
+    years, year, finite = _split(years)
+    millis = years_to_millis(np.where(finite, years, year))
+    return np.where(finite, millis.astype('datetime64[ms]'), np.datetime64('NaT', 'ms'))
+
+
+def millis_to_years(millis) -> np.ndarray:
+    """Convert milliseconds since the epoch to fractional years.
+
+    Examples:
+        >>> millis_to_years([1609459200000, 1593648000000])
+        array([2021. , 2020.5])
+        >>> years = np.random.default_rng(1).uniform(1971, 2037, 1000)
+        >>> bool(np.all(np.abs(millis_to_years(years_to_millis(years)) - years) < 1e-10))
+        True
+    """
+    millis = np.asarray(millis, dtype=np.int64)
+    year = millis.astype('datetime64[ms]').astype('datetime64[Y]').astype(np.int64) + 1970
+    start = _year_start_millis(year)
+    return year + (millis - start) / (_year_start_millis(year + 1) - start)
+
+
+def datetime64_to_years(dates) -> np.ndarray:
+    """Convert datetime64 values to fractional years, NaN for NaT.
+
+    Examples:
+        >>> datetime64_to_years(np.array(['2021-06-01T02:00:01', 'NaT'], dtype='datetime64[s]'))
+        array([2021.41392697,           nan])
+        >>> from datetime import datetime, timezone
+        >>> def date_to_year(date):  # utils.date_to_year, in UTC instead of local time
+        ...     t = datetime.fromisoformat(date).replace(tzinfo=timezone.utc)
+        ...     start, end = (datetime(year, 1, 1, tzinfo=timezone.utc) for year in (t.year, t.year + 1))
+        ...     return t.year + (t - start) / (end - start)
+        >>> years = datetime64_to_years(np.array(['2021-06-01T02:00:01', '2020-02-29'], dtype='datetime64[s]'))
+        >>> [date_to_year(d) for d in ['2021-06-01T02:00:01', '2020-02-29T00:00:00']] == years.tolist()
+        True
+    """
+    dates = np.asarray(dates).astype('datetime64[ms]')
+    nat = np.isnat(dates)
+    years = millis_to_years(np.where(nat, np.datetime64(0, 'ms'), dates).astype(np.int64))
+    return np.where(nat, np.nan, years)
+
+
+def years_to_doy(years) -> tuple[np.ndarray, np.ndarray]:
+    """Convert fractional years to their calendar year and day of year, starting at 1.
+
+    Examples:
+        >>> years_to_doy([2020.999, 2021.999, 2020.0])
+        (array([2020, 2021, 2020]), array([366, 365,   1]))
+    """
+    years, year, finite = _split(years)
+    if not finite.all():
+        raise ValueError('Cannot convert non-finite years to days of year')
+    return year, (years_to_millis(years) - _year_start_millis(year)) // MILLIS_PER_DAY + 1
+
+
+def doy_to_years(year, doy) -> np.ndarray:
+    """Convert calendar years and days of year, starting at 1, to the fractional years of the start of those days.
+
+    Examples:
+        >>> doy_to_years([2020, 2021], [184, 183])
+        array([2020.5       , 2021.49863014])
+        >>> year, doy = years_to_doy(doy_to_years(2024, np.arange(1, 367)))
+        >>> bool(np.all(doy == np.arange(1, 367)))
+        True
+    """
+    year = np.asarray(year, dtype=np.int64)
+    return millis_to_years(_year_start_millis(year) + (np.asarray(doy, dtype=np.int64) - 1) * MILLIS_PER_DAY)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()